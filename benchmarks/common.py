@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_DIR = os.path.join(ROOT_DIR, "bot")
+
+
+def setup_environment(work_dir: str = None) -> str:
+    """
+    Prepares the environment to import bot modules: bot database and logs are created in a temporary working directory
+    instead of the project ones. Must be called before importing any bot module.
+    Args:
+        work_dir: Working directory. If not passed, temporary directory is created and removed at exit.
+
+    Returns:
+        Working directory.
+    """
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="bot_benchmark_")
+        atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+    os.makedirs(os.path.join(work_dir, "bot"), exist_ok=True)
+    locale_link = os.path.join(work_dir, "bot", "locale")
+    if not os.path.exists(locale_link):
+        os.symlink(os.path.join(BOT_DIR, "locale"), locale_link)
+
+    os.chdir(work_dir)
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ.setdefault("NOTIFICATION_FREQUENCY", "1")
+    sys.path.insert(0, BOT_DIR)
+    return work_dir
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Returns percentile of provided values.
+    Args:
+        values: Measured values.
+        percent: Required percentile, f.e. 99.
+
+    Returns:
+        Percentile or 0 if there are no values.
+    """
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns peak resident set size of the current process.
+
+    Returns:
+        Peak RSS in megabytes.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is measured in bytes on macOS and in kilobytes on Linux.
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def get_commit() -> str | None:
+    """
+    Returns current git commit of the project.
+
+    Returns:
+        Commit hash or None if it can't be defined.
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(benchmark: str, params: dict, results: dict, output: str = None) -> dict:
+    """
+    Writes benchmark results as JSON, so the results of different commits can be compared.
+    Args:
+        benchmark: Benchmark name.
+        params: Benchmark parameters.
+        results: Measured results.
+        output: Path to output file. If not passed, results are printed to stdout.
+
+    Returns:
+        Written report.
+    """
+
+    report = {
+        "benchmark": benchmark,
+        "commit": get_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    data = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w") as file:
+            file.write(data + "\n")
+    else:
+        print(data)
+    return report
@@ -0,0 +1,215 @@
+"""
+Load test of update processing: every user goes through the same dialog (start, timezone change by city name, time
+frame menu, today tasks) at the same time, a new dialog step of all users arrives every "interval" seconds. Geocoder
+is replaced by a stand-in with fixed latency, users type one of "cities" different city names, so the rest of
+lookups are served by geocoding cache. Handlers call a local stub of Telegram Bot API. Handler latency is measured
+from the update arrival till the end of its processing. Database queries per update are taken from bot metrics.
+In "asyncio" runtime every update is an asyncio task of aio.AsyncUpdateBot running the same handlers in a pool of
+"--workers" threads.
+
+Usage:
+    python benchmarks/concurrent_updates.py --users 50 --workers 0 --output sequential.json
+    python benchmarks/concurrent_updates.py --users 50 --workers 16 --output concurrent.json
+    python benchmarks/concurrent_updates.py --users 50 --cities 5
+    python benchmarks/concurrent_updates.py --users 50 --navigation resend
+    python benchmarks/concurrent_updates.py --users 1000 --runtime asyncio
+
+Translations must be compiled (bot/locale/*/LC_MESSAGES/messages.mo) as for running the bot itself.
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import threading
+from geopy import Location
+from common import setup_environment, percentile, peak_rss_mb, write_results
+from stub_api import StubBotAPI
+
+# Dialog steps: ("message", text) or ("callback", data).
+DIALOG = [
+    ("message", "/start"),
+    ("callback", "tz"),
+    ("message", "city"),
+    ("callback", "timeset"),
+    ("callback", "back"),
+    ("callback", "read_today"),
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="number of concurrent users")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads",
+                        help="updates dispatched by update workers (main) or asyncio tasks (aio)")
+    parser.add_argument("--workers", type=int, default=16, help="number of update workers (0 - sequential)")
+    parser.add_argument("--interval", type=float, default=0.5, help="interval between dialog steps in seconds")
+    parser.add_argument("--geocode-latency", type=float, default=0.2, help="geocoding latency in seconds")
+    parser.add_argument("--cities", type=int, help="number of different city names (every user's own by default)")
+    parser.add_argument("--navigation", choices=["edit", "resend"], default="edit", help="menu navigation mode")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="stub Bot API latency in seconds")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def make_update(update_id: int, user_id: int, kind: str, value: str) -> dict:
+    """
+    Makes an update sent by the user.
+    Args:
+        update_id: Update ID.
+        user_id: User and chat ID.
+        kind: "message" or "callback".
+        value: Message text or callback data.
+
+    Returns:
+        Update data.
+    """
+
+    user = {"id": user_id, "is_bot": False, "first_name": f"user_{user_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user, "text": value}
+    if kind == "message":
+        if value.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value)}]
+        return {"update_id": update_id, "message": message}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "chat_instance": str(user_id),
+                                                       "from": user, "message": message, "data": value}}
+
+
+def make_batches(users: int, cities: int) -> list[list[dict]]:
+    """
+    Makes updates of every dialog step of all the users.
+    Args:
+        users: Number of users.
+        cities: Number of different city names.
+
+    Returns:
+        List of update batches, one per dialog step.
+    """
+
+    batches = []
+    update_id = 0
+    for kind, value in DIALOG:
+        batch = []
+        for user_id in range(1, users + 1):
+            update_id += 1
+            text = f"Moscow {user_id % cities}" if value == "city" else value
+            batch.append(make_update(update_id, user_id, kind, text))
+        batches.append(batch)
+    return batches
+
+
+class StandInGeocoder:
+    """
+    Geocoder finding every city in Moscow after fixed latency.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def geocode(self, query: str) -> Location:
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return Location(query, (55.7558, 37.6173), {})
+
+
+def main() -> None:
+    args = parse_args()
+    setup_environment(args.work_dir)
+    stub = StubBotAPI(latency=args.api_latency).start()
+    os.environ["BOT_API_URL"] = stub.url
+    os.environ["UPDATE_WORKERS"] = str(args.workers)
+    os.environ["NAVIGATION_MODE"] = args.navigation
+
+    from telebot import TeleBot, types
+    from loader import geocoding, metrics
+    from migrations import migrate
+
+    geocoder = geocoding.geocoder = StandInGeocoder(args.geocode_latency)
+    batches = make_batches(args.users, args.cities or args.users)
+    arrived_at, finished_at, errors = {}, {}, []
+    migrate()
+
+    from loader import bot, navigator, session, TOKEN
+    import main as bot_main  # registers handlers
+
+    if args.runtime == "asyncio":
+        from aio import AsyncUpdateBot
+
+        async_bot = AsyncUpdateBot(TOKEN, bot, max(args.workers, 1), on_done=session.remove, on_error=errors.append)
+        process_update = AsyncUpdateBot.process_update
+
+        async def timed_process_update(self, update: types.Update, previous: asyncio.Task | None = None) -> None:
+            await process_update(self, update, previous)
+            finished_at[update.update_id] = time.perf_counter()
+
+        async def run_dialog() -> float:
+            started_at = time.perf_counter()
+            for step, batch in enumerate(batches):
+                arrival = started_at + step * args.interval
+                await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+                for data in batch:
+                    arrived_at[data["update_id"]] = arrival
+                await async_bot.process_new_updates([types.Update.de_json(data) for data in batch])
+            await async_bot.join()
+            return time.perf_counter() - started_at
+
+        AsyncUpdateBot.process_update = timed_process_update
+        duration = asyncio.run(run_dialog())
+    else:
+        process_new_updates = TeleBot.process_new_updates
+
+        def timed_process_new_updates(self, updates: list) -> None:
+            process_new_updates(self, updates)
+            now = time.perf_counter()
+            for update in updates:
+                finished_at[update.update_id] = now
+
+        TeleBot.process_new_updates = timed_process_new_updates
+        if bot.executor is not None:
+            bot.executor.on_error = errors.append
+
+        started_at = time.perf_counter()
+        for step, batch in enumerate(batches):
+            arrival = started_at + step * args.interval
+            time.sleep(max(0.0, arrival - time.perf_counter()))
+            for data in batch:
+                arrived_at[data["update_id"]] = arrival
+            try:
+                bot.process_new_updates([types.Update.de_json(data) for data in batch])
+            except Exception as e:
+                errors.append(e)
+        if bot.executor is not None:
+            bot.executor.join()
+        duration = time.perf_counter() - started_at
+    stub.stop()
+
+    latencies = [finished_at[update_id] - arrival for update_id, arrival in arrived_at.items()
+                 if update_id in finished_at]
+    results = {
+        "updates": len(arrived_at),
+        "processed": len(finished_at),
+        "handler_errors": [f"{e.__class__.__name__}: {e}" for e in errors],
+        "duration_s": duration,
+        "handler_latency_p50_s": percentile(latencies, 50),
+        "handler_latency_p99_s": percentile(latencies, 99),
+        "handler_latency_max_s": max(latencies, default=0.0),
+        "geocoder_calls": geocoder.calls,
+        "api_calls": dict(stub.calls),
+        "api_calls_per_update": sum(stub.calls.values()) / len(arrived_at) if arrived_at else 0.0,
+        "navigation_calls": dict(navigator.calls),
+        "navigation_fallbacks": navigator.fallbacks,
+        "db_queries_per_update": {update_type: total / count for (update_type,), (buckets, total, count)
+                                  in metrics.update_queries.values.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    params = {key: value for key, value in vars(args).items() if key not in ("work_dir", "output")}
+    write_results("concurrent_updates", params, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of inline keyboards generation: building and serializing keyboard on every call (keyboards.build_keyboard)
+versus cached serialized keyboards (keyboards.get_keyboard). Every update handled by bot sends one keyboard, so the
+difference is the saving per update.
+
+Usage:
+    python benchmarks/keyboards.py --repeat 10000 --output result.json
+
+Translations must be compiled (bot/locale/*/LC_MESSAGES/messages.mo) as for running the bot itself.
+"""
+
+import time
+import argparse
+from common import setup_environment, percentile, write_results
+
+KEYBOARDS = [
+    ("base", None),
+    ("back", None),
+    ("ok", None),
+    ("language", None),
+    ("retry", None),
+    ("clock", None),
+    ("clock_menu", False),
+    ("clock_menu", True),
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10000, help="number of calls per keyboard and language")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def measure(func, repeat: int) -> dict:
+    """
+    Measures duration of function calls.
+    Args:
+        func: Function without arguments.
+        repeat: Number of calls.
+
+    Returns:
+        Call duration percentiles in microseconds.
+    """
+
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started_at)
+    return {
+        "call_p50_us": percentile(durations, 50) * 1e6,
+        "call_p99_us": percentile(durations, 99) * 1e6,
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    setup_environment(args.work_dir)
+
+    from loader import i18n
+    from keyboards import get_keyboard, build_keyboard
+
+    results = {}
+    for language in i18n.available_translations:
+        i18n.context_lang.language = language
+        for keyboard_type, muted in KEYBOARDS:
+            name = keyboard_type if muted is None else f"{keyboard_type}_{'muted' if muted else 'unmuted'}"
+            built = measure(lambda: build_keyboard(keyboard_type, muted=muted).to_json(), args.repeat)
+            cached = measure(lambda: get_keyboard(keyboard_type, muted=muted), args.repeat)
+            results[f"{language}.{name}"] = {
+                "build": built,
+                "cached": cached,
+                "saving_per_update_us": built["call_p50_us"] - cached["call_p50_us"],
+            }
+
+    write_results("keyboards", {"repeat": args.repeat}, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark of logging on the mailing hot path: "threads" mailing workers log every delivered notification. Compares
+the file handler called by every worker (as before log_handlers.start_queue_logging), the queue written by background
+thread and the queue with per-recipient lines at DEBUG level and progress sampled once per 1000 notifications
+(as dispatcher.NotificationDispatcher does). Measures per-call latency and throughput of the workers. Mailing rate
+is limited by --rate as the real mailing is, --write-delay emulates slow storage (every record is written that long).
+
+Usage:
+    python benchmarks/log_calls.py --mode file
+    python benchmarks/log_calls.py --mode queue --rate 2000 --write-delay 0.002
+    python benchmarks/log_calls.py --mode queue --format json
+    python benchmarks/log_calls.py --mode sampled --output sampled.json
+"""
+
+import os
+import time
+import atexit
+import logging
+import argparse
+import threading
+from common import setup_environment, percentile, peak_rss_mb, write_results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["file", "queue", "sampled"], default="queue",
+                        help="file handler in every worker, background queue writer or queue with sampled lines")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="log format of queue modes")
+    parser.add_argument("--threads", type=int, default=8, help="number of mailing workers")
+    parser.add_argument("--messages", type=int, default=20000, help="number of notifications per worker")
+    parser.add_argument("--rate", type=float, default=0, help="notifications per second of all workers (0 - no limit)")
+    parser.add_argument("--write-delay", type=float, default=0, help="delay of every log record write in seconds")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    work_dir = setup_environment(args.work_dir)
+
+    from log_handlers import TEXT_FORMAT, DATE_FORMAT, get_file_handler, start_queue_logging
+
+    path = os.path.join(work_dir, "log_calls.log")
+    if args.mode == "file":
+        logging.basicConfig(level=logging.INFO, filename=path, filemode="w", format=TEXT_FORMAT, datefmt=DATE_FORMAT)
+        listener = None
+    else:
+        listener = start_queue_logging(get_file_handler(path, max_bytes=10 * 1024 * 1024),
+                                       json_format=args.format == "json")
+    logger = logging.getLogger("bot")
+    if args.write_delay:
+        handler = listener.handlers[0] if listener is not None else logging.getLogger().handlers[0]
+        emit = handler.emit
+
+        def slow_emit(record: logging.LogRecord) -> None:
+            time.sleep(args.write_delay)
+            emit(record)
+
+        handler.emit = slow_emit
+    interval = args.threads / args.rate if args.rate else 0
+
+    latencies = [[] for _ in range(args.threads)]
+    sent = 0
+    lock = threading.Lock()
+
+    def worker(number: int) -> None:
+        nonlocal sent
+        next_at = time.perf_counter()
+        for message in range(args.messages):
+            if interval:
+                next_at += interval
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+            chat_id = number * args.messages + message
+            started_at = time.perf_counter()
+            if args.mode == "sampled":
+                with lock:
+                    sent += 1
+                    count = sent
+                logger.debug("Notification successfully sent to %s", chat_id)
+                if count % 1000 == 0:
+                    logger.info(f"{count} notifications sent")
+            else:
+                logger.info(f"Notification successfully sent to {chat_id}")
+            latencies[number].append(time.perf_counter() - started_at)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.threads)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started_at
+    if listener is not None:
+        listener.stop()
+        atexit.unregister(listener.stop)
+    flushed = time.perf_counter() - started_at
+
+    calls = [latency for worker_latencies in latencies for latency in worker_latencies]
+    results = {
+        "calls": len(calls),
+        "duration_s": duration,
+        "calls_per_s": len(calls) / duration if duration else 0.0,
+        "call_p50_us": percentile(calls, 50) * 1e6,
+        "call_p99_us": percentile(calls, 99) * 1e6,
+        "flushed_s": flushed,
+        "log_size_mb": os.path.getsize(path) / 1024 / 1024,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    params = {key: value for key, value in vars(args).items() if key not in ("work_dir", "output")}
+    write_results("log_calls", params, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Benchmark of the notification pipeline: send list generation (utils.get_send_list) and mailing
+(main.send_notification) against a local stub of Telegram Bot API.
+
+Usage:
+    python benchmarks/notification_pipeline.py --users 50000 --timezones 100 --tasks-per-day 3 --output result.json
+    python benchmarks/notification_pipeline.py --users 50000 --runtime asyncio --concurrency 200
+
+Translations must be compiled (bot/locale/*/LC_MESSAGES/messages.mo) as for running the bot itself.
+"""
+
+import os
+import time
+import random
+import argparse
+import datetime
+from common import setup_environment, percentile, peak_rss_mb, write_results
+from stub_api import StubBotAPI
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000, help="number of users")
+    parser.add_argument("--timezones", type=int, default=50, help="number of distinct user timezones")
+    parser.add_argument("--tasks-per-day", type=int, default=3, help="number of tasks of each user per day")
+    parser.add_argument("--muted", type=float, default=0.2, help="share of users with muted notifications")
+    parser.add_argument("--repeat", type=int, default=3, help="number of send list generation runs")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="stub Bot API latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of mailing workers")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads",
+                        help="mailing runtime: thread pool (main.send_notification) or asyncio (aio.AsyncRuntime)")
+    parser.add_argument("--rate-limit", type=float, default=100000, help="mailing rate limit (messages per second)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="mailing batch size")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of synthetic data")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def seed_database(args: argparse.Namespace, utc_now: datetime.datetime) -> float:
+    """
+    Fills the database with synthetic users and tasks. Every user is notified from 00:00 till 23:00 and has
+    "tasks_per_day" tasks on each date the user local date can be on.
+
+    Returns:
+        Seeding duration in seconds.
+    """
+
+    import pytz
+    from loader import session
+    from models import Users, ToDos
+    from migrations import migrate
+
+    started_at = time.perf_counter()
+    migrate()
+    rnd = random.Random(args.seed)
+    timezones = pytz.common_timezones[::max(1, len(pytz.common_timezones) // args.timezones)][:args.timezones]
+    dates = [utc_now.date() + datetime.timedelta(days=days) for days in (-1, 0, 1)]
+    chunk = 10000
+
+    for start in range(0, args.users, chunk):
+        user_ids = range(start + 1, min(args.users, start + chunk) + 1)
+        session.execute(Users.__table__.insert(), [{
+            "id": user_id,
+            "telegram_user_id": user_id,
+            "telegram_user_name": f"user_{user_id}",
+            "chat_id": user_id,
+            "timezone": rnd.choice(timezones),
+            "language": rnd.choice(["ru", "en"]),
+            "notifications_from": datetime.time(0),
+            "notifications_to": datetime.time(23),
+            "muted": rnd.random() < args.muted,
+        } for user_id in user_ids])
+        session.execute(ToDos.__table__.insert(), [
+            {"user_id": user_id, "todo": f"Task {number} of user {user_id}", "todo_date": date}
+            for user_id in user_ids for date in dates for number in range(args.tasks_per_day)
+        ])
+        session.commit()
+    return time.perf_counter() - started_at
+
+
+def benchmark_send_list(args: argparse.Namespace, utc_now: datetime.datetime) -> dict:
+    """
+    Measures send list generation without sending anything.
+
+    Returns:
+        Send list generation results.
+    """
+
+    from utils import get_send_list
+
+    durations, first_message = [], []
+    size = 0
+    for _ in range(args.repeat):
+        started_at = time.perf_counter()
+        size = 0
+        for _ in get_send_list(utc_now):
+            if size == 0:
+                first_message.append(time.perf_counter() - started_at)
+            size += 1
+        durations.append(time.perf_counter() - started_at)
+
+    return {
+        "messages": size,
+        "duration_p50_s": percentile(durations, 50),
+        "duration_min_s": min(durations),
+        "time_to_first_message_p50_s": percentile(first_message, 50),
+        "messages_per_s": size / percentile(durations, 50) if size else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def benchmark_mailing(args: argparse.Namespace) -> dict:
+    """
+    Measures the whole mailing: send list generation, notifications ledger and dispatching to stub Bot API.
+
+    Returns:
+        Mailing results.
+    """
+
+    if args.runtime == "asyncio":
+        import asyncio
+        from loader import bot
+        from aio import AsyncRuntime
+
+        async def send_notification():
+            runtime = AsyncRuntime(bot)
+            try:
+                return await runtime.send_notification()
+            finally:
+                await runtime.engine.dispose()
+
+        stats = asyncio.run(send_notification())
+    else:
+        from main import send_notification
+
+        stats = send_notification()
+    return {
+        "sent": stats.sent,
+        "failed": stats.failed,
+        "duration_s": stats.duration,
+        "messages_per_s": stats.throughput,
+        "api_latency_p50_s": stats.percentile(50),
+        "api_latency_p99_s": stats.percentile(99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    setup_environment(args.work_dir)
+    stub = StubBotAPI(latency=args.api_latency).start()
+    os.environ["BOT_API_URL"] = stub.url
+    os.environ["MAILING_CONCURRENCY"] = str(args.concurrency)
+    os.environ["MAILING_RATE_LIMIT"] = str(args.rate_limit)
+    os.environ["MAILING_BATCH_SIZE"] = str(args.batch_size)
+
+    utc_now = datetime.datetime.utcnow()
+    results = {"seed_duration_s": seed_database(args, utc_now)}
+    results["send_list"] = benchmark_send_list(args, utc_now)
+    results["mailing"] = benchmark_mailing(args)
+    results["api_calls"] = dict(stub.calls)
+    results["api_connections"] = stub.connections
+    stub.stop()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("work_dir", "output")}
+    write_results("notification_pipeline", params, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import json
+import socket
+import time
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubBotAPI:
+    """
+    Local stand-in of Telegram Bot API server. Every method succeeds after the configured latency and returns
+    a message built from request params. Used by benchmarks instead of real Telegram API.
+    """
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.calls = Counter()
+        # Number of accepted TCP connections. Connections are kept alive, so it shows how clients reuse them.
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """
+        Bot API URL template to be set as telebot.apihelper.API_URL (or BOT_API_URL environment variable).
+        """
+
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self) -> "StubBotAPI":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self) -> type:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+                # Headers and body are written separately, so Nagle's algorithm would delay the body.
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stub.lock:
+                    stub.connections += 1
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                params = {key: value[0] for key, value in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    params.update({key: value[0] for key, value in parse_qs(body).items()})
+                method = url.path.rsplit("/", 1)[-1]
+                with stub.lock:
+                    stub.calls[method] += 1
+                    message_id = sum(stub.calls.values())
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                chat_id = int(params.get("chat_id") or 0)
+                result = {"message_id": message_id, "date": int(time.time()), "text": params.get("text", ""),
+                          "chat": {"id": chat_id, "type": "private"}}
+                data = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_POST = do_GET
+
+        return Handler
@@ -0,0 +1,82 @@
+"""
+Benchmark of timezone lookups by coordinates: a new TimezoneFinder on every call (as before geocoding.TimezoneResolver)
+versus long-lived resolver with polygon data read from files or kept in memory. Measures startup time, per-call
+latency of new and repeated coordinates, batch lookup and peak RSS. Run every mode in a separate process to compare RSS.
+
+Usage:
+    python benchmarks/timezones.py --mode per-call --points 20
+    python benchmarks/timezones.py --mode file --output file.json
+    python benchmarks/timezones.py --mode memory --output memory.json
+"""
+
+import time
+import random
+import argparse
+from common import setup_environment, percentile, peak_rss_mb, write_results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["per-call", "file", "memory"], default="file",
+                        help="new TimezoneFinder per call or long-lived resolver with file or in-memory data")
+    parser.add_argument("--points", type=int, default=2000, help="number of different coordinates")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of coordinates")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def measure(func, points: list[tuple[float, float]]) -> dict:
+    """
+    Measures duration of lookups.
+    Args:
+        func: Function of latitude and longitude.
+        points: Coordinates.
+
+    Returns:
+        Call duration percentiles in microseconds.
+    """
+
+    durations = []
+    for latitude, longitude in points:
+        started_at = time.perf_counter()
+        func(latitude, longitude)
+        durations.append(time.perf_counter() - started_at)
+    return {
+        "call_p50_us": percentile(durations, 50) * 1e6,
+        "call_p99_us": percentile(durations, 99) * 1e6,
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    setup_environment(args.work_dir)
+
+    from timezonefinder import TimezoneFinder
+    from geocoding import TimezoneResolver
+
+    rng = random.Random(args.seed)
+    points = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(args.points)]
+    results = {}
+    if args.mode == "per-call":
+        results["lookup"] = measure(lambda lat, lng: TimezoneFinder().timezone_at(lng=lng, lat=lat), points)
+    else:
+        started_at = time.perf_counter()
+        resolver = TimezoneResolver(in_memory=args.mode == "memory", cache_size=args.points)
+        resolver.warm()
+        results["startup_s"] = time.perf_counter() - started_at
+        results["lookup"] = measure(resolver.timezone_at, points)
+        results["cached_lookup"] = measure(resolver.timezone_at, points)
+
+        resolver.cache.clear()
+        started_at = time.perf_counter()
+        resolver.timezones_at(points)
+        results["batch_per_point_us"] = (time.perf_counter() - started_at) / len(points) * 1e6
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("work_dir", "output")}
+    write_results("timezones", params, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+End-to-end test and benchmark of webhook mode: recorded updates (data/updates.json) are POSTed to local
+webhook.WebhookServer on behalf of several users, handlers call a local stub of Telegram Bot API. Also checks that
+requests with invalid secret token are rejected. Set UPDATE_WORKERS environment variable to test concurrent update
+processing.
+
+Usage:
+    python benchmarks/webhook.py --users 100 --output result.json
+    python benchmarks/webhook.py --updates recorded.json
+
+Translations must be compiled (bot/locale/*/LC_MESSAGES/messages.mo) as for running the bot itself.
+"""
+
+import os
+import copy
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+from common import setup_environment, percentile, peak_rss_mb, write_results
+from stub_api import StubBotAPI
+
+UPDATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "updates.json")
+SECRET = "benchmark-secret"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="number of users replaying recorded updates")
+    parser.add_argument("--updates", default=UPDATES_PATH, help="path to JSON list of recorded updates")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="stub Bot API latency in seconds")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def for_user(update: dict, user_id: int, update_id: int) -> dict:
+    """
+    Makes a copy of recorded update sent by another user.
+    Args:
+        update: Recorded update.
+        user_id: User and chat ID.
+        update_id: Update ID.
+
+    Returns:
+        Update of the user.
+    """
+
+    update = copy.deepcopy(update)
+    update["update_id"] = update_id
+    for key in ("message", "callback_query"):
+        if key in update:
+            body = update[key]
+            body["from"]["id"] = user_id
+            message = body.get("message", body)
+            message["chat"]["id"] = user_id
+    return update
+
+
+def post(url: str, data: dict, secret: str = SECRET) -> int:
+    """
+    POSTs the update to webhook server.
+    Returns:
+        Response status code.
+    """
+
+    request = urllib.request.Request(url, data=json.dumps(data).encode(), method="POST",
+                                     headers={"Content-Type": "application/json",
+                                              "X-Telegram-Bot-Api-Secret-Token": secret})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main() -> None:
+    args = parse_args()
+    with open(args.updates) as file:
+        recorded = json.load(file)
+    setup_environment(args.work_dir)
+    stub = StubBotAPI(latency=args.api_latency).start()
+    os.environ["BOT_API_URL"] = stub.url
+
+    from loader import bot
+    from migrations import migrate
+    from webhook import WebhookServer
+    import main as bot_main  # registers handlers
+
+    migrate()
+    errors = []
+    server = WebhookServer(bot, secret_token=SECRET, host="127.0.0.1", port=0, on_error=errors.append)
+    if bot.executor is not None:
+        bot.executor.on_error = errors.append
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.address
+    url = f"http://{host}:{port}{server.path}"
+
+    statuses, latencies = Counter(), []
+    update_id = 0
+    started_at = time.perf_counter()
+    for user_id in range(1, args.users + 1):
+        for update in recorded:
+            update_id += 1
+            request_started_at = time.perf_counter()
+            statuses[post(url, for_user(update, user_id, update_id))] += 1
+            latencies.append(time.perf_counter() - request_started_at)
+    if bot.executor is not None:
+        bot.executor.join()
+    duration = time.perf_counter() - started_at
+
+    rejected = post(url, for_user(recorded[0], 1, update_id + 1), secret="wrong-secret")
+    server.stop()
+    stub.stop()
+
+    results = {
+        "updates": update_id,
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "handler_errors": [f"{e.__class__.__name__}: {e}" for e in errors],
+        "invalid_secret_status": rejected,
+        "duration_s": duration,
+        "updates_per_s": update_id / duration if duration else 0.0,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p99_s": percentile(latencies, 99),
+        "api_calls": dict(stub.calls),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    params = {key: value for key, value in vars(args).items() if key not in ("work_dir", "output")}
+    write_results("webhook", params, results, args.output)
+    if errors or rejected != 403 or set(statuses) != {200}:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark of concurrent task and settings writes: "threads" users create tasks and change settings at the same time
+as in the morning task entry. Every write is committed at once (--window 0) or by group commit writer collecting
+writes within the window (writer.GroupCommitWriter). With --scan-users mailing list of that many users is generated
+in a loop at the same time. Measures throughput, per-operation latency and failed writes.
+
+Usage:
+    python benchmarks/writes.py --threads 16 --window 0 --output direct.json
+    python benchmarks/writes.py --threads 16 --window 0.005 --output group.json
+    SQLITE_JOURNAL_MODE=DELETE python benchmarks/writes.py --window 0 --scan-users 20000
+"""
+
+import os
+import time
+import datetime
+import argparse
+import threading
+from common import setup_environment, percentile, peak_rss_mb, write_results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16, help="number of concurrent users")
+    parser.add_argument("--operations", type=int, default=50, help="number of writes per user")
+    parser.add_argument("--window", type=float, default=0.005, help="group commit window in seconds (0 - disabled)")
+    parser.add_argument("--scan-users", type=int, default=0, help="number of users scanned by concurrent mailing")
+    parser.add_argument("--work-dir", help="working directory for database and logs (temporary by default)")
+    parser.add_argument("--output", help="path to JSON results file (stdout by default)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    setup_environment(args.work_dir)
+    os.environ["GROUP_COMMIT_WINDOW"] = str(args.window)
+
+    from loader import session, mailing_session
+    from models import Users, ToDos
+    from migrations import migrate
+    from crud import create_user, create_task
+    from utils import set_language, get_send_list
+
+    migrate()
+    for user_id in range(1, args.threads + 1):
+        create_user(telegram_user_id=user_id, telegram_user_name=f"user_{user_id}", chat_id=user_id)
+    scan_ids = range(args.threads + 1, args.threads + args.scan_users + 1)
+    if scan_ids:
+        session.execute(Users.__table__.insert(), [{
+            "telegram_user_id": user_id, "telegram_user_name": f"user_{user_id}", "chat_id": user_id,
+            "notifications_from": datetime.time(0), "notifications_to": datetime.time(23),
+        } for user_id in scan_ids])
+        session.execute(ToDos.__table__.insert(), [
+            {"user_id": user_id, "todo": f"Task of user {user_id}", "todo_date": datetime.date.today()}
+            for user_id in scan_ids
+        ])
+        session.commit()
+
+    latencies, failed = [], []
+    lock = threading.Lock()
+    today = datetime.date.today()
+
+    def user(user_id: int) -> None:
+        for number in range(args.operations):
+            started_at = time.perf_counter()
+            if number % 5 == 4:
+                success = set_language("en" if number % 2 else "ru", user_id)
+            else:
+                success = create_task(user_id, f"Task {number}", today)
+            latency = time.perf_counter() - started_at
+            with lock:
+                latencies.append(latency)
+                if not success:
+                    failed.append(user_id)
+        session.remove()
+
+    scans = []
+    writing = threading.Event()
+
+    def scan() -> None:
+        while writing.is_set():
+            for _ in get_send_list(datetime.datetime.utcnow()):
+                pass
+            scans.append(1)
+        mailing_session.remove()
+
+    threads = [threading.Thread(target=user, args=(user_id,)) for user_id in range(1, args.threads + 1)]
+    scanner = threading.Thread(target=scan)
+    started_at = time.perf_counter()
+    writing.set()
+    if scan_ids:
+        scanner.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started_at
+    writing.clear()
+    if scan_ids:
+        scanner.join()
+
+    results = {
+        "writes": len(latencies),
+        "failed": len(failed),
+        "duration_s": duration,
+        "writes_per_s": len(latencies) / duration if duration else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1e3,
+        "latency_p99_ms": percentile(latencies, 99) * 1e3,
+        "mailing_scans": len(scans),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    params = {key: value for key, value in vars(args).items() if key not in ("work_dir", "output")}
+    write_results("writes", params, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
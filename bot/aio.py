@@ -0,0 +1,385 @@
+import time
+import asyncio
+import datetime
+import functools
+import aiohttp
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Iterator
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_engine
+from metrics import BotMetrics
+from workers import UpdateBot, get_chat_id
+from webhook import WebhookServer
+from outbox import NotificationOutbox, get_slot
+from utils import get_send_list, update_next_fire
+from dispatcher import NotificationDispatcher, MailingStats
+from loader import logger, session, TOKEN, BOT_API_URL, NOTIFICATION_FREQUENCY, MAILING_CONCURRENCY, \
+    MAILING_RATE_LIMIT, MAILING_BATCH_SIZE, UPDATE_MODE, UPDATE_WORKERS, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_HOST, \
+    WEBHOOK_PORT, WEBHOOK_PATH, metrics
+
+if BOT_API_URL:
+    asyncio_helper.API_URL = BOT_API_URL
+
+
+async def iterate(session: AsyncSession, make_iterator: Callable[[Session], Iterator], batch_size: int) \
+        -> AsyncIterator:
+    """
+    Iterates synchronous iterator performing database queries (f.e. utils.get_send_list) with async session.
+    The iterator is advanced by batches inside AsyncSession.run_sync, so its queries are run by async driver and
+    don't block the event loop.
+    Args:
+        session: Async session.
+        make_iterator: Function creating the iterator by sync session.
+        batch_size: Number of items taken from the iterator at once.
+
+    Returns:
+        Async iterator of the same items.
+    """
+
+    iterator = None
+
+    def next_batch(sync_session: Session) -> list:
+        nonlocal iterator
+        if iterator is None:
+            iterator = make_iterator(sync_session)
+        return list(islice(iterator, batch_size))
+
+    while batch := await session.run_sync(next_batch):
+        for item in batch:
+            yield item
+
+
+class InstrumentedSessionManager(asyncio_helper.SessionManager):
+    """
+    Session manager of AsyncTeleBot creating HTTP sessions whose Bot API calls are observed by bot metrics, as the calls
+    of loader.http_session are in threads runtime.
+    """
+
+    def __init__(self, metrics: BotMetrics):
+        super().__init__()
+        self.metrics = metrics
+
+    async def create_session(self) -> aiohttp.ClientSession:
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=asyncio_helper.REQUEST_LIMIT, ssl=self.ssl_context),
+            trace_configs=[self.metrics.get_trace_config()]
+        )
+        return self.session
+
+
+class AsyncNotificationDispatcher(NotificationDispatcher):
+    """
+    Sends notifications by asyncio tasks instead of threads, so the number of concurrent API calls isn't limited by
+    the number of threads. Telegram limits are respected the same way as in NotificationDispatcher.
+    """
+
+    async def dispatch(self, send_list: AsyncIterator[tuple[int, str]], on_sent: Callable[[int], None] = None,
+                       on_failed: Callable[[int, Exception], None] = None) -> MailingStats:
+        """
+        Sends notifications via provided mailing list.
+        Args:
+            send_list: Async iterator of (chat ID, message) pairs.
+            on_sent: Function called with chat ID after the notification is delivered.
+            on_failed: Function called with chat ID and the last error if the notification can't be sent.
+
+        Returns:
+            Mailing statistics.
+        """
+
+        stats = MailingStats()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def task(chat_id: int, text: str) -> None:
+            try:
+                error = await self.deliver(chat_id, text, stats)
+                if error is None and on_sent is not None:
+                    on_sent(chat_id)
+                elif error is not None and on_failed is not None:
+                    on_failed(chat_id, error)
+            finally:
+                slots.release()
+
+        async for chat_id, text in send_list:
+            await slots.acquire()
+            running = asyncio.create_task(task(chat_id, text))
+            tasks.add(running)
+            running.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        stats.finished_at = time.monotonic()
+        self.last_sent.clear()
+        return stats
+
+    async def deliver(self, chat_id: int, text: str, stats: MailingStats) -> Exception | None:
+        """
+        Sends single notification retrying it if Telegram API asks to.
+        Args:
+            chat_id: Chat ID in Telegram.
+            text: Notification text.
+            stats: Statistics of current mailing.
+
+        Returns:
+            None if success else the last sending error.
+        """
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            while (delay := self.bucket.reserve()) > 0:
+                await asyncio.sleep(delay)
+            delay = self.reserve_chat(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started_at = time.monotonic()
+            try:
+                await self.bot.send_message(chat_id, text)
+            except Exception as e:
+                error = e
+                if self.should_retry(chat_id, e, attempt, stats):
+                    continue
+                break
+            self.register_sent(chat_id, started_at, stats)
+            return None
+
+        with stats.lock:
+            stats.failed += 1
+        return error
+
+
+class AsyncUpdateBot(AsyncTeleBot):
+    """
+    AsyncTeleBot receiving updates in the event loop. Every received update is processed by its own asyncio task, which
+    passes it to the handlers registered in workers.UpdateBot and runs them by the pool of threads, so both runtimes
+    share the same handlers. Updates of the same chat are processed one by one in order of arrival, so the dialog
+    steps of every chat stay ordered.
+    """
+
+    def __init__(self, token: str, bot: UpdateBot, workers: int, on_done: Callable[[], None] = None,
+                 on_error: Callable[[Exception], None] = None):
+        super().__init__(token)
+        self.update_bot = bot
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update")
+        self.on_done = on_done
+        self.on_error = on_error
+        # Chat ID as key, task processing the last received update of the chat as value.
+        self.chats = {}
+
+    def handle(self, update: types.Update) -> None:
+        """
+        Passes single update to TeleBot handlers. Runs in a thread of the pool.
+        Args:
+            update: Telegram update.
+
+        Returns:
+            None
+        """
+
+        try:
+            self.update_bot.process_update(update)
+        except Exception as e:
+            logger.exception(f"Update of chat {get_chat_id(update)} failed")
+            if self.on_error is not None:
+                self.on_error(e)
+        finally:
+            if self.on_done is not None:
+                self.on_done()
+
+    async def process_update(self, update: types.Update, previous: asyncio.Task | None = None) -> None:
+        """
+        Processes single update after the previous update of the chat is processed.
+        Args:
+            update: Telegram update.
+            previous: Task processing the previous update of the chat.
+
+        Returns:
+            None
+        """
+
+        if previous is not None:
+            await asyncio.wait([previous])
+        await asyncio.get_running_loop().run_in_executor(self.pool, self.handle, update)
+
+    async def process_new_updates(self, updates: list[types.Update]) -> None:
+        for update in updates:
+            chat_id = get_chat_id(update)
+            key = chat_id if chat_id is not None else object()
+            task = asyncio.create_task(self.process_update(update, self.chats.get(key)))
+            self.chats[key] = task
+            task.add_done_callback(functools.partial(self.release, key))
+
+    def release(self, key, task: asyncio.Task) -> None:
+        """
+        Forgets the chat after its last received update is processed.
+        Args:
+            key: Chat key.
+            task: Finished task.
+
+        Returns:
+            None
+        """
+
+        if self.chats.get(key) is task:
+            del self.chats[key]
+
+    async def join(self) -> None:
+        """
+        Waits until all received updates are processed.
+        Returns:
+            None
+        """
+
+        while self.chats:
+            await asyncio.wait(list(self.chats.values()))
+
+
+class WebhookUpdates:
+    """
+    Passes updates received by webhook.WebhookServer in its thread to AsyncUpdateBot in the event loop.
+    """
+
+    def __init__(self, bot: AsyncUpdateBot, loop: asyncio.AbstractEventLoop):
+        self.bot = bot
+        self.loop = loop
+
+    def process_new_updates(self, updates: list[types.Update]) -> None:
+        # Waits until the updates are queued for processing, so the updates of a chat keep the order of requests.
+        asyncio.run_coroutine_threadsafe(self.bot.process_new_updates(updates), self.loop).result()
+
+
+class AsyncRuntime:
+    """
+    Asyncio runtime of the bot. Receiving updates, notification scheduler and mailing are tasks of one event loop.
+    Mailing database queries are performed by async engine (aiosqlite) and notifications are sent by AsyncTeleBot.
+    Every update is processed by an asyncio task running the handlers of workers.UpdateBot in a pool of threads.
+    """
+
+    def __init__(self, bot: UpdateBot, on_error: Callable[[Exception], None] = None):
+        self.bot = bot
+        self.on_error = on_error
+        self.async_bot = AsyncUpdateBot(TOKEN, bot, max(UPDATE_WORKERS, 8), on_done=session.remove, on_error=on_error)
+        self.engine = get_async_engine()
+        metrics.instrument_engine(self.engine.sync_engine)
+        asyncio_helper.session_manager = InstrumentedSessionManager(metrics)
+
+    def get_dispatcher(self) -> AsyncNotificationDispatcher:
+        return AsyncNotificationDispatcher(self.async_bot, concurrency=MAILING_CONCURRENCY,
+                                           rate_limit=MAILING_RATE_LIMIT)
+
+    async def send_notification(self) -> MailingStats:
+        """
+        Asyncio version of main.send_notification: sends notifications via mailing list generated by
+        utils.get_send_list, writes them to notifications ledger and moves the next notification time forward.
+        Returns:
+            Mailing statistics.
+        """
+
+        utc_now = datetime.datetime.utcnow()
+        async with AsyncSession(self.engine) as async_session:
+            outbox = NotificationOutbox(async_session.sync_session, get_slot(utc_now), batch_size=MAILING_BATCH_SIZE)
+            await async_session.run_sync(lambda sync_session: outbox.purge())
+            await async_session.run_sync(lambda sync_session: outbox.abandon_stale())
+            logger.info(f"Starting mailing for slot {outbox.slot}")
+            send_list = iterate(async_session, lambda sync_session: outbox.write(get_send_list(utc_now, sync_session)),
+                                MAILING_BATCH_SIZE)
+            stats = await self.get_dispatcher().dispatch(send_list, on_sent=outbox.mark_sent,
+                                                         on_failed=outbox.mark_failed)
+            await async_session.run_sync(lambda sync_session: outbox.flush())
+            await async_session.run_sync(lambda sync_session: update_next_fire(utc_now, sync_session))
+        metrics.observe_mailing(stats)
+        logger.info(f"Mailing finished. {stats}")
+        return stats
+
+    async def resume_notification(self) -> None:
+        """
+        Asyncio version of main.resume_notification: sends notifications of the current slot which were written to
+        notifications ledger but not delivered and abandons undelivered notifications of past slots.
+        Returns:
+            None
+        """
+
+        async with AsyncSession(self.engine) as async_session:
+            outbox = NotificationOutbox(async_session.sync_session, get_slot(), batch_size=MAILING_BATCH_SIZE)
+            if abandoned := await async_session.run_sync(lambda sync_session: outbox.abandon_stale()):
+                logger.warning(f"{abandoned} undelivered notifications of past slots abandoned")
+            send_list = iterate(async_session, lambda sync_session: outbox.pending(), MAILING_BATCH_SIZE)
+            stats = await self.get_dispatcher().dispatch(send_list, on_sent=outbox.mark_sent,
+                                                         on_failed=outbox.mark_failed)
+            await async_session.run_sync(lambda sync_session: outbox.flush())
+        if stats.sent or stats.failed:
+            metrics.observe_mailing(stats)
+            logger.info(f"Interrupted mailing for slot {outbox.slot} resumed. {stats}")
+
+    async def schedule_notifications(self) -> None:
+        """
+        Runs mailing every NOTIFICATION_FREQUENCY hours at the beginning of an hour. Interrupted mailings are resumed
+        first, so the resumed and the scheduled mailings never send the same notifications at the same time.
+        Returns:
+            None
+        """
+
+        await self.supervise(self.resume_notification)
+        frequency = datetime.timedelta(hours=int(NOTIFICATION_FREQUENCY))
+        next_run = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        while True:
+            await asyncio.sleep((next_run - datetime.datetime.now()).total_seconds())
+            await self.supervise(self.send_notification)
+            while next_run <= datetime.datetime.now():
+                next_run += frequency
+
+    async def receive_updates(self) -> None:
+        """
+        Receives updates by long polling or via webhook according to UPDATE_MODE.
+        Returns:
+            None
+        """
+
+        if UPDATE_MODE == "webhook":
+            await self.async_bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+            updates = WebhookUpdates(self.async_bot, asyncio.get_running_loop())
+            server = WebhookServer(updates, secret_token=WEBHOOK_SECRET, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                                   path=WEBHOOK_PATH, on_error=self.on_error)
+            try:
+                await asyncio.to_thread(server.serve_forever)
+            finally:
+                server.stop()
+        else:
+            await self.async_bot.remove_webhook()
+            await self.async_bot.polling(non_stop=True)
+
+    async def supervise(self, task: Callable[[], Awaitable]) -> None:
+        """
+        Runs the task reporting its error instead of stopping the event loop.
+        Args:
+            task: Coroutine function.
+
+        Returns:
+            None
+        """
+
+        try:
+            await task()
+        except Exception as e:
+            logger.exception(f"{task.__name__} failed")
+            if self.on_error is not None:
+                await asyncio.to_thread(self.on_error, e)
+
+    async def run(self) -> None:
+        """
+        Runs the bot: starts scheduler (it resumes interrupted mailing first) and receives updates. Receiving updates is
+        restarted after errors.
+        Returns:
+            None
+        """
+
+        scheduler = asyncio.create_task(self.schedule_notifications())
+        try:
+            while True:
+                await self.supervise(self.receive_updates)
+                await asyncio.sleep(1)
+        finally:
+            scheduler.cancel()
+            await self.engine.dispose()
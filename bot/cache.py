@@ -0,0 +1,75 @@
+import threading
+from typing import Any, Hashable
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe bounded cache. When the cache is full, the least recently used item is evicted.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        """
+        Returns cached item.
+        Args:
+            key: Item key.
+
+        Returns:
+            Cached item or None if it isn't cached.
+        """
+
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key: Hashable, item: Any) -> None:
+        """
+        Caches item.
+        Args:
+            key: Item key.
+            item: Item to cache.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.items[key] = item
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Removes item from cache.
+        Args:
+            key: Item key.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes all items from cache.
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.items.clear()
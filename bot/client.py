@@ -1,4 +1,5 @@
 import requests
+from transport import get_http_session
 
 
 class TelegramClient:
@@ -6,9 +7,13 @@ class TelegramClient:
     Implements telegram client class to send critical error messages to bot admin when exceptions happen.
     """
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, session: requests.Session = None, timeout: tuple[float, float] = (5, 30)):
         self.base_url = "https://api.telegram.org"
         self.token = token
+        # Session with kept alive connections, f.e. the one shared with the bot.
+        self.session = session or get_http_session(pool_size=1)
+        # Connect and read timeouts in seconds.
+        self.timeout = timeout
 
     def make_request_url(self, method: str = None) -> str:
         """
@@ -27,7 +32,7 @@ class TelegramClient:
 
     def post(self, method: str = None, params: dict = None, body: dict = None) -> int:
         """
-
+        Sends POST request to Telegram API.
         Args:
             method: Telegram API method, f.e "sendMessage".
             params: Params query string.
@@ -37,5 +42,5 @@ class TelegramClient:
             Response status code.
         """
 
-        response = requests.post(url=self.make_request_url(method), params=params, data=body)
+        response = self.session.post(url=self.make_request_url(method), params=params, data=body, timeout=self.timeout)
         return response.status_code
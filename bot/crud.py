@@ -1,8 +1,9 @@
 import datetime
 from sqlalchemy import exc
 from sqlalchemy import and_
+from sqlalchemy.orm import Session
 from models import Users, ToDos
-from loader import _, logger, session
+from loader import _, logger, session, writer
 
 
 def get_tasks(user_id: int, date: datetime.date) -> dict | None:
@@ -64,14 +65,15 @@ def create_task(user_id: int, task: str, date: str) -> bool:
         True if success else False.
     """
 
-    try:
-        task = ToDos(
-            user_id=session.query(Users.id).filter(Users.telegram_user_id == user_id).scalar(),
+    def create(write_session: Session) -> None:
+        write_session.add(ToDos(
+            user_id=write_session.query(Users.id).filter(Users.telegram_user_id == user_id).scalar(),
             todo=task,
             todo_date=date
-        )
-        session.add(task)
-        session.commit()
+        ))
+
+    try:
+        writer.run(create)
         logger.info(f"User {user_id} successfully scheduled new task on {date}")
         return True
     except exc.SQLAlchemyError:
@@ -90,12 +92,14 @@ def update_task(task_id: int, edited_task: str) -> bool:
         True if success else False.
     """
 
-    try:
-        task = session.query(ToDos).filter(ToDos.id == task_id).one_or_none()
+    def update(write_session: Session) -> bool:
+        task = write_session.query(ToDos).filter(ToDos.id == task_id).one_or_none()
         if task:
             task.todo = edited_task
-            session.add(task)
-            session.commit()
+        return task is not None
+
+    try:
+        if writer.run(update):
             logger.info(f"Task with ID {task_id} was successfully updated")
             return True
         else:
@@ -116,11 +120,14 @@ def delete_task(task_id: str) -> bool:
         True if success else False.
     """
 
-    try:
-        task = session.query(ToDos).filter(ToDos.id == task_id).one_or_none()
+    def delete(write_session: Session) -> bool:
+        task = write_session.query(ToDos).filter(ToDos.id == task_id).one_or_none()
         if task:
-            session.delete(task)
-            session.commit()
+            write_session.delete(task)
+        return task is not None
+
+    try:
+        if writer.run(delete):
             logger.info(f"Task with ID {task_id} was successfully deleted")
             return True
         else:
@@ -143,14 +150,15 @@ def create_user(telegram_user_id: int, telegram_user_name: str, chat_id: int) ->
         True if success else False.
     """
 
-    try:
-        user = Users(
+    def create(write_session: Session) -> None:
+        write_session.add(Users(
             telegram_user_id=telegram_user_id,
             telegram_user_name=telegram_user_name,
             chat_id=chat_id
-        )
-        session.add(user)
-        session.commit()
+        ))
+
+    try:
+        writer.run(create)
         logger.info(f"Successfully registered new user with telegram ID {telegram_user_id}")
         return True
     except exc.SQLAlchemyError:
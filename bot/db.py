@@ -1,32 +1,81 @@
 import os
 
 import sqlalchemy.engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+import sqlalchemy.ext.asyncio
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import create_engine, event
 
 db_directory = "db"
 db_name = "remindmebot.db"
+# Number of connections kept open. More connections are opened if needed and closed when returned to the pool.
+pool_size = 10
+
+engine = None
+
+
+def get_pragmas() -> dict:
+    """
+    Returns SQLite pragmas set for every connection. They are read from environment variables when the connection is
+    opened, so the values from .env file are used. WAL journal lets the mailing read users while handlers write.
+
+    Returns:
+        Dict with pragma name as key and its value.
+    """
+
+    return {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        # Negative value is the cache size in KiB.
+        "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", -16000)),
+        "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 128 * 1024 * 1024)),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+    }
+
+
+def set_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    Sets SQLite pragmas of new connection.
+    Args:
+        dbapi_connection: DBAPI connection.
+        connection_record: Pool record of the connection.
+
+    Returns:
+        None
+    """
+
+    cursor = dbapi_connection.cursor()
+    for name, value in get_pragmas().items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
 
 
 def get_db() -> sqlalchemy.engine.Engine:
     """
-    Returns sqlalchemy engine instance.
+    Returns sqlalchemy engine instance. The engine is created once and shared by the whole process. Connections are
+    pooled, every connection is used by one thread at a time.
 
     Returns:
         Engine instance.
     """
 
+    global engine
+    if engine is not None:
+        return engine
+
     if not os.path.exists(db_directory):
         os.mkdir(db_directory)
 
-    engine = create_engine(f"sqlite:///{db_directory}/{db_name}?check_same_thread=False", echo=False)
+    engine = create_engine(f"sqlite:///{db_directory}/{db_name}", connect_args={"check_same_thread": False},
+                           poolclass=QueuePool, pool_size=pool_size, max_overflow=-1, echo=False)
+    event.listen(engine, "connect", set_pragmas)
 
     return engine
 
 
 def get_session() -> sqlalchemy.orm.Session:
     """
-    Returns sqlalchemy session instance.
+    Returns sqlalchemy session instance. The session must be used by one thread only.
 
     Returns:
         Session instance.
@@ -36,3 +85,33 @@ def get_session() -> sqlalchemy.orm.Session:
     session = Session()
     return session
 
+
+def get_scoped_session() -> sqlalchemy.orm.scoped_session:
+    """
+    Returns sqlalchemy thread-local session registry. It's used as session, but every thread works with its own
+    session instance.
+
+    Returns:
+        Scoped session instance.
+    """
+
+    return scoped_session(sessionmaker(bind=get_db()))
+
+
+def get_async_engine() -> sqlalchemy.ext.asyncio.AsyncEngine:
+    """
+    Returns sqlalchemy asyncio engine instance working via aiosqlite driver. It's imported on demand, so aiosqlite is
+    required for asyncio runtime only.
+
+    Returns:
+        Async engine instance.
+    """
+
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    if not os.path.exists(db_directory):
+        os.mkdir(db_directory)
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_directory}/{db_name}", echo=False)
+    event.listen(async_engine.sync_engine, "connect", set_pragmas)
+    return async_engine
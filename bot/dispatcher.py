@@ -0,0 +1,322 @@
+import time
+import random
+import threading
+from typing import Iterable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from telebot import TeleBot
+from loader import logger
+
+
+def get_delivery_status(error: Exception) -> str:
+    """
+    Defines user delivery status by the error received while sending notification.
+    Args:
+        error: Sending error.
+
+    Returns:
+        "blocked" if user has blocked the bot, "deactivated" if user account or chat doesn't exist anymore, else
+        "active", i.e. the error is temporary.
+    """
+
+    # Sync and asyncio telebot clients raise different ApiTelegramException classes with the same attributes.
+    if hasattr(error, "error_code"):
+        match error.description:
+            case "Forbidden: bot was blocked by the user":
+                return "blocked"
+            case "Forbidden: user is deactivated" | "Bad Request: chat not found":
+                return "deactivated"
+    return "active"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of requests to Telegram API.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token if it's available.
+        Returns:
+            0 if the token is taken, else time in seconds to wait before trying again.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and takes it.
+        Returns:
+            None
+        """
+
+        while (delay := self.reserve()) > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stops giving out tokens for the provided period. Used when Telegram API responds with "retry_after".
+        Args:
+            seconds: Pause duration.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated_at = self.paused_until
+
+
+class MailingStats:
+    """
+    Collects delivery results and latencies of a single mailing run.
+    """
+
+    reservoir_size = 10000
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.seen = 0
+        self.latencies = []
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def add_latency(self, latency: float) -> None:
+        """
+        Saves API call latency. Latencies are reservoir sampled, so memory doesn't depend on the mailing size.
+        Args:
+            latency: API call latency in seconds.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.seen += 1
+            if len(self.latencies) < self.reservoir_size:
+                self.latencies.append(latency)
+            else:
+                index = random.randrange(self.seen)
+                if index < self.reservoir_size:
+                    self.latencies[index] = latency
+
+    def percentile(self, percent: float) -> float:
+        """
+        Returns latency percentile.
+        Args:
+            percent: Required percentile, f.e. 99.
+
+        Returns:
+            Latency in seconds or 0 if nothing was sent.
+        """
+
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.duration if self.duration else 0.0
+
+    def __str__(self) -> str:
+        return (f"sent: {self.sent}, failed: {self.failed}, retries: {self.retries}, "
+                f"duration: {self.duration:.2f}s, throughput: {self.throughput:.2f} msg/s, "
+                f"latency p50: {self.percentile(50) * 1000:.0f}ms, p99: {self.percentile(99) * 1000:.0f}ms")
+
+
+class NotificationDispatcher:
+    """
+    Sends notifications by bounded pool of workers. Respects Telegram limits: global rate limit is implemented via
+    token bucket, single chat can't receive messages more often than once per "per_chat_interval" seconds. If
+    Telegram API responds with 429 error code, all the workers are paused for "retry_after" seconds.
+    Delivered notifications are logged per recipient at DEBUG level only, the progress is logged once per "log_every"
+    notifications.
+    """
+
+    def __init__(self, bot: TeleBot, concurrency: int = 8, rate_limit: float = 30, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, log_every: int = 1000):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate=rate_limit)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.log_every = log_every
+        self.last_sent = {}
+        self.last_sent_lock = threading.Lock()
+
+    def dispatch(self, send_list: Iterable[tuple[int, str]], on_sent: Callable[[int], None] = None,
+                 on_failed: Callable[[int, Exception], None] = None) -> MailingStats:
+        """
+        Sends notifications via provided mailing list.
+        Args:
+            send_list: Iterable of (chat ID, message) pairs.
+            on_sent: Function called by worker with chat ID after the notification is delivered.
+            on_failed: Function called by worker with chat ID and the last error if the notification can't be sent.
+
+        Returns:
+            Mailing statistics.
+        """
+
+        stats = MailingStats()
+        # Limits the number of queued messages, so the mailing list is consumed as fast as it is sent.
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+
+        def task(chat_id: int, text: str) -> None:
+            try:
+                error = self.deliver(chat_id, text, stats)
+                if error is None and on_sent is not None:
+                    on_sent(chat_id)
+                elif error is not None and on_failed is not None:
+                    on_failed(chat_id, error)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="mailing") as executor:
+            for chat_id, text in send_list:
+                slots.acquire()
+                executor.submit(task, chat_id, text)
+        stats.finished_at = time.monotonic()
+        self.last_sent.clear()
+        return stats
+
+    def wait_for_chat(self, chat_id: int) -> None:
+        """
+        Blocks until the chat is allowed to receive the next message.
+        Args:
+            chat_id: Chat ID in Telegram.
+
+        Returns:
+            None
+        """
+
+        delay = self.reserve_chat(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve_chat(self, chat_id: int) -> float:
+        """
+        Reserves the time the chat is allowed to receive the next message at.
+        Args:
+            chat_id: Chat ID in Telegram.
+
+        Returns:
+            Time in seconds to wait before sending.
+        """
+
+        with self.last_sent_lock:
+            now = time.monotonic()
+            if len(self.last_sent) >= self.concurrency * 64:
+                # Forgets the chats that already can receive messages, so memory doesn't grow with the mailing size.
+                self.last_sent = {chat: sent_at for chat, sent_at in self.last_sent.items()
+                                  if sent_at + self.per_chat_interval > now}
+            send_at = max(now, self.last_sent.get(chat_id, 0.0) + self.per_chat_interval)
+            self.last_sent[chat_id] = send_at
+        return send_at - now
+
+    def deliver(self, chat_id: int, text: str, stats: MailingStats) -> Exception | None:
+        """
+        Sends single notification retrying it if Telegram API asks to.
+        Args:
+            chat_id: Chat ID in Telegram.
+            text: Notification text.
+            stats: Statistics of current mailing.
+
+        Returns:
+            None if success else the last sending error.
+        """
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self.wait_for_chat(chat_id)
+            started_at = time.monotonic()
+            try:
+                self.bot.send_message(chat_id, text)
+            except Exception as e:
+                error = e
+                if self.should_retry(chat_id, e, attempt, stats):
+                    continue
+                break
+            self.register_sent(chat_id, started_at, stats)
+            return None
+
+        with stats.lock:
+            stats.failed += 1
+        return error
+
+    def should_retry(self, chat_id: int, error: Exception, attempt: int, stats: MailingStats) -> bool:
+        """
+        Logs sending error and defines if the notification should be sent again. If Telegram API asks to retry later,
+        the token bucket is paused.
+        Args:
+            chat_id: Chat ID in Telegram.
+            error: Sending error.
+            attempt: Number of the failed attempt starting from 0.
+            stats: Statistics of current mailing.
+
+        Returns:
+            True if the notification should be sent again else False.
+        """
+
+        if not hasattr(error, "error_code"):
+            logger.error(f"Can't send notification to {chat_id}: {error}")
+            return False
+        if error.error_code == 429 and attempt < self.max_retries:
+            retry_after = error.result_json.get("parameters", {}).get("retry_after", 1)
+            logger.warning(f"Flood limit exceeded while sending notification to {chat_id}. "
+                           f"Retry after {retry_after}s")
+            self.bucket.pause(retry_after)
+            with stats.lock:
+                stats.retries += 1
+            return True
+        if error.description == "Forbidden: bot was blocked by the user":
+            logger.error(f"Attention! User {chat_id} has blocked the bot.")
+        else:
+            logger.error(f"Can't send notification to {chat_id}: {error.description}")
+        return False
+
+    def register_sent(self, chat_id: int, started_at: float, stats: MailingStats) -> None:
+        """
+        Saves delivered notification to mailing statistics.
+        Args:
+            chat_id: Chat ID in Telegram.
+            started_at: Time the API call was started at.
+            stats: Statistics of current mailing.
+
+        Returns:
+            None
+        """
+
+        stats.add_latency(time.monotonic() - started_at)
+        with stats.lock:
+            stats.sent += 1
+            sent = stats.sent
+        logger.debug("Notification successfully sent to %s", chat_id)
+        if self.log_every and sent % self.log_every == 0:
+            logger.info(f"{sent} notifications sent")
@@ -0,0 +1,238 @@
+import re
+import datetime
+import threading
+import unicodedata
+import sqlalchemy.engine
+from typing import Iterable, Protocol
+from geopy import Location
+from sqlalchemy import and_, bindparam, select, delete
+from sqlalchemy.dialects.sqlite import insert
+from timezonefinder import TimezoneFinder
+from cache import LRUCache
+from models import Base, GeocodeCache
+
+CYRILLIC = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i", "й": "i",
+    "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f",
+    "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "iu",
+    "я": "ia", "і": "i", "ї": "i", "є": "ie", "ґ": "g",
+}
+TRANSLITERATION = str.maketrans(CYRILLIC)
+
+
+class Geocoder(Protocol):
+    """
+    Geocoder interface. Any geopy geocoder (f.e. Nominatim) can be used, benchmarks use local stand-ins.
+    """
+
+    def geocode(self, query: str) -> Location | None:
+        ...
+
+
+class Place:
+    """
+    Geocoded city with its timezone.
+    """
+
+    def __init__(self, latitude: float, longitude: float, timezone: str):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timezone = timezone
+
+
+def normalize_city(city: str | None) -> str:
+    """
+    Returns cache key of the city name: case, whitespace, punctuation and diacritics are ignored, cyrillic is
+    transliterated, so "  Нижний-Новгород" and "nizhnii novgorod" share the key.
+    Args:
+        city: City name typed by user.
+
+    Returns:
+        Normalized city name, empty if there are no letters or digits.
+    """
+
+    if not city:
+        return ""
+    city = unicodedata.normalize("NFKC", city).casefold().translate(TRANSLITERATION)
+    city = "".join(char for char in unicodedata.normalize("NFKD", city) if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[\W_]+", " ", city).split())
+
+
+class TimezoneResolver:
+    """
+    Long-lived thread-safe timezone finder by coordinates. Polygon data is read once: kept in memory if "in_memory"
+    is set (lower latency) or read from data files on demand (lower RSS). Results of recently resolved coordinates
+    are cached.
+    """
+
+    def __init__(self, in_memory: bool = False, cache_size: int = 1000):
+        self.finder = TimezoneFinder(in_memory=in_memory)
+        # TimezoneFinder reads its data by seeking shared file objects, so lookups must not run concurrently.
+        self.lock = threading.Lock()
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def warm(self) -> None:
+        """
+        Makes the first lookup, so the data pages are loaded before the first user request.
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.finder.timezone_at(lng=37.6173, lat=55.7558)
+
+    def timezone_at(self, latitude: float, longitude: float) -> str | None:
+        """
+        Returns timezone name by coordinates.
+        Args:
+            latitude: Latitude.
+            longitude: Longitude.
+
+        Returns:
+            Timezone name or None if the point has no timezone.
+        """
+
+        return self.timezones_at([(latitude, longitude)])[0]
+
+    def timezones_at(self, points: Iterable[tuple[float, float]]) -> list[str | None]:
+        """
+        Returns timezone names of many points at once, f.e. to re-resolve timezones of many users. Cached and repeated
+        points are resolved once, the rest are resolved under a single lock.
+        Args:
+            points: (latitude, longitude) pairs.
+
+        Returns:
+            Timezone names (None if the point has no timezone) in order of points.
+        """
+
+        keys = [(round(latitude, 6), round(longitude, 6)) for latitude, longitude in points]
+        timezones = {key: self.cache.get(key) for key in set(keys)}
+        missing = [key for key, timezone in timezones.items() if timezone is None]
+        if missing:
+            with self.lock:
+                for key in missing:
+                    timezones[key] = self.finder.timezone_at(lng=key[1], lat=key[0])
+            for key in missing:
+                if timezones[key] is not None:
+                    self.cache.put(key, timezones[key])
+        return [timezones[key] for key in keys]
+
+
+class GeocodingCache:
+    """
+    Geocoder with persistent cache in "geocode_cache" table of bot database. Cities are cached by normalized name
+    for "ttl" seconds, cities which weren't found are cached for "negative_ttl" seconds, so the geocoder is called
+    only for new or expired names. Concurrent lookups of the same name wait for the first one instead of calling the
+    geocoder again. Geocoder errors aren't cached.
+    """
+
+    def __init__(self, geocoder: Geocoder, resolver: TimezoneResolver, engine: sqlalchemy.engine.Engine = None,
+                 ttl: float = 30 * 86400, negative_ttl: float = 86400):
+        self.geocoder = geocoder
+        self.resolver = resolver
+        self.engine = engine or Base.metadata.bind
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # {key: [lock, number of lookups using the lock]}
+        self.locks = {}
+        self.lock = threading.Lock()
+        table = GeocodeCache.__table__
+        self.select_place = select(table.c.latitude, table.c.longitude, table.c.timezone).where(
+            and_(table.c.key == bindparam("city"), table.c.expires_at > bindparam("now")))
+        upsert = insert(table).values(key=bindparam("city"), latitude=bindparam("lat"), longitude=bindparam("lon"),
+                                      timezone=bindparam("tz"), expires_at=bindparam("expires"))
+        self.upsert_place = upsert.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={"latitude": upsert.excluded.latitude, "longitude": upsert.excluded.longitude,
+                  "timezone": upsert.excluded.timezone, "expires_at": upsert.excluded.expires_at},
+        )
+        self.delete_expired = delete(table).where(table.c.expires_at <= bindparam("now"))
+
+    def lookup(self, city: str | None) -> Place | None:
+        """
+        Returns the city coordinates and timezone from cache or from geocoder if the city isn't cached.
+        Args:
+            city: City name typed by user.
+
+        Returns:
+            Place object or None if the city isn't found.
+        """
+
+        key = normalize_city(city)
+        if not key:
+            return None
+        found, place = self.get(key)
+        if found:
+            return place
+
+        with self.lock:
+            lock = self.locks.setdefault(key, [threading.Lock(), 0])
+            lock[1] += 1
+        try:
+            with lock[0]:
+                found, place = self.get(key)
+                if not found:
+                    place = self.geocode(key, city)
+        finally:
+            with self.lock:
+                lock[1] -= 1
+                if not lock[1]:
+                    del self.locks[key]
+        return place
+
+    def get(self, key: str) -> tuple[bool, Place | None]:
+        """
+        Returns cached geocoding result.
+        Args:
+            key: Normalized city name.
+
+        Returns:
+            True and the place (None if the city isn't found) if the result is cached, else False and None.
+        """
+
+        with self.engine.connect() as connection:
+            row = connection.execute(self.select_place, {"city": key, "now": datetime.datetime.utcnow()}).first()
+        if row is None:
+            return False, None
+        return True, Place(row.latitude, row.longitude, row.timezone) if row.timezone is not None else None
+
+    def geocode(self, key: str, city: str) -> Place | None:
+        """
+        Geocodes the city, finds its timezone and caches the result.
+        Args:
+            key: Normalized city name.
+            city: City name typed by user.
+
+        Returns:
+            Place object or None if the city isn't found.
+        """
+
+        location = self.geocoder.geocode(city.strip())
+        place = None
+        if location is not None:
+            timezone = self.resolver.timezone_at(location.latitude, location.longitude)
+            if timezone is not None:
+                place = Place(location.latitude, location.longitude, timezone)
+        self.store(key, place)
+        return place
+
+    def store(self, key: str, place: Place | None) -> None:
+        """
+        Caches geocoding result and removes expired entries.
+        Args:
+            key: Normalized city name.
+            place: Found place or None if the city isn't found.
+
+        Returns:
+            None
+        """
+
+        now = datetime.datetime.utcnow()
+        ttl = self.ttl if place is not None else self.negative_ttl
+        params = {"city": key, "lat": None, "lon": None, "tz": None, "now": now,
+                  "expires": now + datetime.timedelta(seconds=ttl)}
+        if place is not None:
+            params |= {"lat": place.latitude, "lon": place.longitude, "tz": place.timezone}
+        with self.engine.begin() as connection:
+            connection.execute(self.delete_expired, {"now": now})
+            connection.execute(self.upsert_place, params)
@@ -1,8 +1,38 @@
-from loader import _
+from loader import _, i18n
 from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
 
+# Static keyboards serialized to JSON by (keyboard type, language, muted).
+keyboard_cache = {}
+
 
 def get_keyboard(keyboard_type: str, tasks: dict = None, prefix: str = None, muted: bool = None) \
+        -> InlineKeyboardMarkup | str:
+    """
+    Returns keyboard according to "keyboard_type". All keyboards except "tasks" are the same for each language,
+    so they are built once and cached serialized to JSON. Telebot sends such markup as is.
+    Args:
+        keyboard_type: Required keyboard type.
+        tasks: Dict used to generate inline markup with task list.
+        prefix: Prefix ("del_", "upd_") used in generating inline markup with task list. It's used in
+        main.update_delete_user_task function to define user action via callback data.
+        muted: Flag muted is used to properly generate "Mute"/"Unmute" buttons.
+
+    Returns:
+        Inline keyboard markup for "tasks" keyboard, else serialized inline keyboard markup.
+    """
+
+    if keyboard_type == "tasks":
+        return build_keyboard(keyboard_type, tasks=tasks, prefix=prefix)
+
+    key = (keyboard_type, i18n.context_lang.language, bool(muted) if keyboard_type == "clock_menu" else None)
+    markup = keyboard_cache.get(key)
+    if markup is None:
+        markup = build_keyboard(keyboard_type, muted=muted).to_json()
+        keyboard_cache[key] = markup
+    return markup
+
+
+def build_keyboard(keyboard_type: str, tasks: dict = None, prefix: str = None, muted: bool = None) \
         -> InlineKeyboardMarkup:
     """
     Generates different keyboards according to "keyboard_type".
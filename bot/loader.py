@@ -1,15 +1,26 @@
 import os
+import secrets
 import logging
-from db import get_session
+from db import get_db, get_scoped_session
+from cache import LRUCache
+from geocoding import GeocodingCache, TimezoneResolver
 from i18n_class import I18N
+from workers import UpdateBot
+from navigation import Navigator
+from metrics import BotMetrics
+from log_handlers import get_file_handler, start_queue_logging
+from transport import get_http_session
+from writer import DirectWriter, GroupCommitWriter
+from state import MemoryStateStorage, SQLiteStateStorage
+from notifications import NotificationRenderer
 from dotenv import load_dotenv
-from telebot import TeleBot, apihelper
-from telebot.storage.memory_storage import StateMemoryStorage
+from telebot import apihelper
+from geopy.geocoders import Nominatim
 
 
 def get_logger() -> logging.Logger:
     """
-        Configures and creates logger.
+        Configures and creates logger. Records are written to the rotating log file by a background thread.
     Returns:
         Logger instance.
     """
@@ -17,38 +28,118 @@ def get_logger() -> logging.Logger:
     log_directory = "logs"
     if not os.path.exists(log_directory):
         os.makedirs(log_directory)
-    logging.basicConfig(level=logging.INFO, filename="logs/log.log", filemode="w",
-                        format="%(asctime)s : %(levelname)s | %(name)s --- %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    handler = get_file_handler(
+        os.path.join(log_directory, "log.log"),
+        max_bytes=int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+        backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 5)),
+        # f.e. "midnight" to rotate the log daily instead of by size.
+        when=os.environ.get("LOG_ROTATE_WHEN")
+    )
+    start_queue_logging(handler, level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+                        json_format=os.environ.get("LOG_FORMAT", "text") == "json")
     return logging.getLogger("bot")
 
 
-def load_env() -> None:
+def load_env() -> bool:
     """
     Load all the variables found as environment variables in .env file.
     Returns:
-        None
+        True if .env file exists else False.
     """
     dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
 
     if os.path.exists(dotenv_path):
         load_dotenv(dotenv_path)
-    else:
-        logger.critical("Missing .env file. Can't find it in project root directory.")
+        return True
+    return False
 
 
+# Logging settings are read from .env file too, so it's loaded before the logger is configured.
+env_loaded = load_env()
 logger = get_logger()
-session = get_session()
+if not env_loaded:
+    logger.critical("Missing .env file. Can't find it in project root directory.")
+# Handlers may be run by several workers, so every thread has its own session.
+session = get_scoped_session()
+# Notifications are generated in scheduler threads, so they don't share sessions with handlers.
+mailing_session = get_scoped_session()
 
 apihelper.ENABLE_MIDDLEWARE = True
-storage = StateMemoryStorage()
 
 i18n = I18N(translations_path="bot/locale", domain_name="messages")
 _ = i18n.gettext
+renderer = NotificationRenderer(i18n)
 
-load_env()
 TOKEN = os.environ.get("BOT_TOKEN")
+# "threads" or "asyncio".
+RUNTIME = os.environ.get("RUNTIME", "threads")
+# "polling" or "webhook".
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+if UPDATE_MODE == "webhook" and not WEBHOOK_SECRET:
+    # Webhook requests are never accepted without secret token. It's passed to Telegram by set_webhook on every start.
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    logger.warning("WEBHOOK_SECRET isn't set, random secret token is generated")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 80))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 NOTIFICATION_FREQUENCY = os.environ.get("NOTIFICATION_FREQUENCY")
-bot = TeleBot(TOKEN, state_storage=storage, threaded=False)
+MAILING_CONCURRENCY = int(os.environ.get("MAILING_CONCURRENCY", 8))
+MAILING_RATE_LIMIT = float(os.environ.get("MAILING_RATE_LIMIT", 30))
+MAILING_BATCH_SIZE = int(os.environ.get("MAILING_BATCH_SIZE", 1000))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+# Number of workers processing updates of different chats concurrently. If 0, updates are processed one by one.
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 0))
+# "memory" or "sqlite". SQLite storage is shared by all bot processes using the same database.
+STATE_STORAGE = os.environ.get("STATE_STORAGE", "memory")
+STATE_TTL = float(os.environ.get("STATE_TTL", 3600))
+# Cached geocoding results expire in GEOCODE_TTL seconds, cities which weren't found - in GEOCODE_NEGATIVE_TTL.
+GEOCODE_TTL = float(os.environ.get("GEOCODE_TTL", 30 * 86400))
+GEOCODE_NEGATIVE_TTL = float(os.environ.get("GEOCODE_NEGATIVE_TTL", 86400))
+# "file" (timezone polygons are read from data files on demand, lower RSS) or "memory" (lower latency).
+TIMEZONE_DATA = os.environ.get("TIMEZONE_DATA", "file")
+# Writes received within GROUP_COMMIT_WINDOW seconds are committed in one transaction. If 0, every write is committed
+# at once.
+GROUP_COMMIT_WINDOW = float(os.environ.get("GROUP_COMMIT_WINDOW", 0))
+# "edit" (menu screens replace the message with clicked button) or "resend" (the message is deleted and new one is
+# sent).
+NAVIGATION_MODE = os.environ.get("NAVIGATION_MODE", "edit")
+# Errors are sent to bot admin as a digest once per ERROR_DIGEST_INTERVAL seconds.
+ERROR_DIGEST_INTERVAL = float(os.environ.get("ERROR_DIGEST_INTERVAL", 60))
+# Failed polling and scheduler workers are restarted with exponential backoff up to WORKER_MAX_BACKOFF seconds.
+WORKER_MAX_BACKOFF = float(os.environ.get("WORKER_MAX_BACKOFF", 300))
+# Metrics are exposed in Prometheus text format on METRICS_HOST:METRICS_PORT/metrics. If port is 0, they aren't exposed.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 8000))
+BOT_API_URL = os.environ.get("BOT_API_URL")
+if BOT_API_URL:
+    apihelper.API_URL = BOT_API_URL
+# Kept alive connections to Telegram API shared by update workers, mailing workers and admin alerts.
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", MAILING_CONCURRENCY + UPDATE_WORKERS + 2))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+# Failed connections (and 502/503/504 responses to GET requests) are retried HTTP_RETRIES times with jittered backoff.
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5))
+http_session = get_http_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF)
+apihelper.session = http_session
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+metrics = BotMetrics()
+metrics.instrument_engine(get_db())
+metrics.instrument_http_session(http_session)
+if STATE_STORAGE == "sqlite":
+    storage = SQLiteStateStorage(ttl=STATE_TTL)
+else:
+    storage = MemoryStateStorage(ttl=STATE_TTL)
+bot = UpdateBot(TOKEN, workers=UPDATE_WORKERS, on_done=session.remove, state_storage=storage, metrics=metrics)
+navigator = Navigator(bot, mode=NAVIGATION_MODE)
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE)
+writer = GroupCommitWriter(get_db(), window=GROUP_COMMIT_WINDOW) if GROUP_COMMIT_WINDOW > 0 else DirectWriter(session)
+timezones = TimezoneResolver(in_memory=TIMEZONE_DATA == "memory")
+geocoding = GeocodingCache(Nominatim(user_agent="Notification_Bot"), timezones, ttl=GEOCODE_TTL,
+                           negative_ttl=GEOCODE_NEGATIVE_TTL)
 
 
@@ -0,0 +1,93 @@
+import copy
+import json
+import queue
+import atexit
+import logging
+import datetime
+import logging.handlers
+
+TEXT_FORMAT = "%(asctime)s : %(levelname)s | %(name)s --- %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log record as one JSON object per line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts log records to the queue. Unlike QueueHandler, the message and the traceback are kept apart, so they can be
+    written as separate fields, and the caller waits if the queue is full instead of losing the record.
+    """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Arguments may be changed by the caller after logging, so the message is formatted at once.
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def get_file_handler(path: str, max_bytes: int = 0, backup_count: int = 5, when: str = None) -> logging.Handler:
+    """
+    Creates rotating file handler. The log is appended, so it isn't lost on restart.
+    Args:
+        path: Path to log file.
+        max_bytes: The log is rotated when it grows to this size. If 0, the log isn't rotated by size.
+        backup_count: Number of rotated logs kept.
+        when: If set, the log is rotated by time instead of size, f.e. "midnight" (see TimedRotatingFileHandler).
+
+    Returns:
+        Handler instance.
+    """
+
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, encoding="utf-8")
+    return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+
+
+def start_queue_logging(handler: logging.Handler, level: int | str = logging.INFO, json_format: bool = False,
+                        queue_size: int = 10000) -> logging.handlers.QueueListener:
+    """
+    Configures root logger to put records to a queue, the records are written by the handler in a background thread.
+    So the threads calling the logger don't wait for file I/O unless the writer is "queue_size" records behind.
+    The queue is flushed at exit.
+    Args:
+        handler: Handler writing the records.
+        level: Root logger level.
+        json_format: If True, records are written as JSON lines else as text.
+        queue_size: Maximum number of records waiting to be written.
+
+    Returns:
+        Started queue listener.
+    """
+
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+    records = queue.Queue(maxsize=queue_size)
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    logging.basicConfig(level=level, handlers=[LogQueueHandler(records)], force=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,29 +1,37 @@
 import time
 import schedule
-import threading
 from utils import *
-from models import Base
+from migrations import migrate
 from client import TelegramClient
+from supervisor import Supervisor, ErrorDigest
+from webhook import WebhookServer
+from metrics import MetricsServer
+from dispatcher import NotificationDispatcher, MailingStats
+from outbox import NotificationOutbox, get_slot
 from telebot import TeleBot, types
 from telegram_bot_calendar import DetailedTelegramCalendar
-from telebot.apihelper import ApiTelegramException
 from crud import create_task, update_task, view_tasks, delete_task, create_user
-from loader import _, bot, i18n, logger, TOKEN, ADMIN_CHAT_ID, NOTIFICATION_FREQUENCY
+from loader import _, bot, i18n, logger, mailing_session, navigator, timezones, TOKEN, ADMIN_CHAT_ID, \
+    NOTIFICATION_FREQUENCY, MAILING_CONCURRENCY, MAILING_RATE_LIMIT, MAILING_BATCH_SIZE, UPDATE_MODE, WEBHOOK_URL, \
+    WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, RUNTIME, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, \
+    http_session, ERROR_DIGEST_INTERVAL, WORKER_MAX_BACKOFF, METRICS_HOST, METRICS_PORT, metrics
 
-CHOICE = ""
 
-
-def init_menu(message: types.Message) -> None:
+def init_menu(message: types.Message, replace: bool = False) -> None:
     """
     Initializes main(basic) menu.
     Args:
         message: User message.
+        replace: If True, the menu replaces the message (bot message with clicked button) instead of sending new one.
 
     Returns:
         None
     """
 
-    bot.send_message(message.chat.id, _("Please choose the action"), reply_markup=get_keyboard("base"))
+    if replace:
+        navigator.show(message, _("Please choose the action"), reply_markup=get_keyboard("base"))
+    else:
+        bot.send_message(message.chat.id, _("Please choose the action"), reply_markup=get_keyboard("base"))
 
 
 def add_user_task(message: types.Message, **kwargs) -> None:
@@ -32,13 +40,13 @@ def add_user_task(message: types.Message, **kwargs) -> None:
     on database.
     Args:
         message: User message.
-        **kwargs: Used to receive the chosen date.
+        **kwargs: Used to receive the chosen date and ID of the bot message asking for the task.
 
     Returns:
         None
     """
 
-    bot.delete_message(message.chat.id, message.id-1)
+    bot.delete_message(message.chat.id, kwargs.get("prompt_id", message.id - 1))
     bot.delete_message(message.chat.id, message.id)
     if create_task(user_id=message.from_user.id, task=message.text.strip(), date=kwargs.get("date")):
         bot.send_message(message.chat.id, _("✅ The task successfully added!"), reply_markup=get_keyboard("back"))
@@ -66,9 +74,9 @@ def update_user_task(message: types.Message, **kwargs) -> None:
 
 def update_user_timezone(message: types.Message) -> None:
     """
-    Updates the user timezone. Calls utils.get_location function to get user coordinates by provided city,
-    utils.get_timezone_by_location to get timezone by received coordinates and utils.update_timezone function which
-    performs operations on database.
+    Updates the user timezone. Calls utils.get_location function to get user coordinates and timezone by provided
+    city (from geocoding cache if the city was already found), utils.get_timezone_by_location to get timezone and its
+    offset and utils.update_timezone function which performs operations on database.
     Args:
         message: User message.
 
@@ -94,7 +102,8 @@ def update_user_timezone(message: types.Message) -> None:
 def set_context_language(bot_instance: TeleBot, message: types.Message) -> None:
     """
      This middleware handler is called when new updates are coming. It passes the current context language in
-     I18N class.
+     I18N class. The user is resolved here once per update and cached by utils.get_user, so handlers get the same
+     user object without querying database.
 
     Args:
         bot_instance: TeleBot instance.
@@ -117,7 +126,8 @@ def commands_handler(message: types.Message) -> None:
     """
     Handles commands /start and /help.
     If /start, generates the welcome message depending on user status (registered or new) and initializes main menu. If
-    user is new, calls crud.create_user function to register it.
+    user is new, calls crud.create_user function to register it. If user has blocked the bot before, calls
+    utils.activate_user function to include it in mailing again.
     If /help, sends help message.
     Args:
         message: User message.
@@ -130,6 +140,7 @@ def commands_handler(message: types.Message) -> None:
         case "/start":
             user = get_user(message.from_user.id)
             if user:
+                activate_user(user_id=message.from_user.id)
                 bot.reply_to(message, _("👋 Welcome back, {}!").format(message.from_user.first_name))
                 init_menu(message)
             else:
@@ -151,7 +162,7 @@ def basic_menu_handler(call: types.CallbackQuery) -> None:
     list of user tasks by date to send it to user. It also uses utils.get_user_date function to get the exact
     date in user timezone.
     If other commands are received, forwards user to date pick just because choosing the date is the first step of
-    all this commands.
+    all this commands. The command is saved as dialog state of the user in the chat to be used after the date pick.
     Args:
         call: Callback query.
 
@@ -159,18 +170,15 @@ def basic_menu_handler(call: types.CallbackQuery) -> None:
         None
     """
 
-    global CHOICE
-    CHOICE = call.data
-    bot.delete_message(call.message.chat.id, call.message.id)
-    if CHOICE == "read_today":
-        bot.send_message(call.message.chat.id, view_tasks(user_id=call.from_user.id,
-                                                          date=get_user_date(
-                                                              timezone=get_user(
-                                                                  user_id=call.from_user.id).timezone).date()),
-                         reply_markup=get_keyboard("back"))
+    bot.set_state(call.from_user.id, call.data, call.message.chat.id)
+    if call.data == "read_today":
+        navigator.show(call.message, view_tasks(user_id=call.from_user.id,
+                                                date=get_user_date(
+                                                    timezone=get_user(user_id=call.from_user.id).timezone).date()),
+                       reply_markup=get_keyboard("back"))
     else:
         calendar, step = DetailedTelegramCalendar().build()
-        bot.send_message(call.message.chat.id, _("🤖 Ok! Let's choose the date"), reply_markup=calendar)
+        navigator.show(call.message, _("🤖 Ok! Let's choose the date"), reply_markup=calendar)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "tz")
@@ -184,10 +192,9 @@ def timezone_menu_handler(call: types.CallbackQuery) -> None:
         None
     """
 
-    bot.delete_message(call.message.chat.id, call.message.id)
     text = _("🤖 Please tell me in which city are you located and I'll find the proper timezone automatically.\n"
              "The current timezone is:\n*{}*").format(get_user_timezone(call.message.chat.id))
-    bot.send_message(call.message.chat.id, text, parse_mode="Markdown")
+    navigator.show(call.message, text, parse_mode="Markdown")
     bot.register_next_step_handler(call.message, update_user_timezone)
 
 
@@ -206,8 +213,6 @@ def time_menu_handler(call: types.CallbackQuery) -> None:
         None
     """
 
-    global CHOICE
-    bot.delete_message(call.message.chat.id, call.message.id)
     match call.data:
         case "timeset":
             time_from, time_to = get_user_notification_time(user_id=call.from_user.id)
@@ -217,27 +222,24 @@ def time_menu_handler(call: types.CallbackQuery) -> None:
                      "If you want to set notification once a day in a specific time, just choose the same start and "
                      "stop time."
                      "\n_The current time frame is:_\nStart at: *{}* \nStop at: *{}*").format(time_from, time_to)
-            bot.send_message(call.message.chat.id, text, reply_markup=get_keyboard("clock_menu", muted=muted),
-                             parse_mode="Markdown")
+            navigator.show(call.message, text, reply_markup=get_keyboard("clock_menu", muted=muted),
+                           parse_mode="Markdown")
         case "time_from" | "time_to":
-            CHOICE = call.data
-            bot.send_message(call.message.chat.id, _("🤖 Please select the required time"),
-                             reply_markup=get_keyboard("clock"))
+            bot.set_state(call.from_user.id, call.data, call.message.chat.id)
+            navigator.show(call.message, _("🤖 Please select the required time"), reply_markup=get_keyboard("clock"))
         case "time_mute" | "time_unmute":
             if mute_user_notifications(user_id=call.from_user.id):
-                bot.send_message(call.message.chat.id, _("🤖 Success"),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, _("🤖 Success"), reply_markup=get_keyboard("back"))
             else:
-                bot.send_message(call.message.chat.id, _("🤖 Whoops. Something went wrong"),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, _("🤖 Whoops. Something went wrong"), reply_markup=get_keyboard("back"))
         case _:
             user_time = call.data.removeprefix("time_")
-            if update_user_notifications(user_id=call.from_user.id, choice=CHOICE, time=user_time):
-                bot.send_message(call.message.chat.id, _("🤖 The time frame was successfully updated"),
-                                 reply_markup=get_keyboard("back"))
+            choice = bot.get_state(call.from_user.id, call.message.chat.id)
+            if update_user_notifications(user_id=call.from_user.id, choice=choice, time=user_time):
+                navigator.show(call.message, _("🤖 The time frame was successfully updated"),
+                               reply_markup=get_keyboard("back"))
             else:
-                bot.send_message(call.message.chat.id, _("🤖 Whoops. Something went wrong"),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, _("🤖 Whoops. Something went wrong"), reply_markup=get_keyboard("back"))
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("lang"))
@@ -252,24 +254,20 @@ def language_menu(call: types.CallbackQuery) -> None:
         None
     """
 
-    bot.delete_message(call.message.chat.id, call.message.id)
     match call.data:
         case "lang":
-            bot.send_message(call.message.chat.id, _("🤖 Choose the language "),
-                             reply_markup=get_keyboard("language"))
+            navigator.show(call.message, _("🤖 Choose the language "), reply_markup=get_keyboard("language"))
         case "lang_ru" | "lang_en":
             language = call.data.removeprefix("lang_")
             if set_language(language=language, user_id=call.from_user.id):
                 match language:
                     case "ru":
-                        bot.send_message(call.message.chat.id, "🇷🇺 Установлен русский язык!",
-                                         reply_markup=get_keyboard("ok"))
+                        navigator.show(call.message, "🇷🇺 Установлен русский язык!", reply_markup=get_keyboard("ok"))
                     case "en":
-                        bot.send_message(call.message.chat.id, "🇺🇸 The language is set to English!",
-                                         reply_markup=get_keyboard("ok"))
+                        navigator.show(call.message, "🇺🇸 The language is set to English!",
+                                       reply_markup=get_keyboard("ok"))
             else:
-                bot.send_message(call.message.chat.id, _("🤖 Whoops. Something went wrong"),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, _("🤖 Whoops. Something went wrong"), reply_markup=get_keyboard("back"))
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "back")
@@ -283,8 +281,7 @@ def back(call: types.CallbackQuery) -> None:
         None
     """
 
-    bot.delete_message(call.message.chat.id, call.message.id)
-    init_menu(call.message)
+    init_menu(call.message, replace=True)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("del_") or call.data.startswith("upd_"))
@@ -302,17 +299,14 @@ def update_delete_user_task(call: types.CallbackQuery) -> None:
 
     prefix = call.data[:4]
     task_id = call.data[4:]
-    bot.delete_message(call.message.chat.id, call.message.id)
     match prefix:
         case "del_":
             if delete_task(task_id=task_id):
-                bot.send_message(call.message.chat.id, _("✅ The task successfully deleted!"),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, _("✅ The task successfully deleted!"), reply_markup=get_keyboard("back"))
             else:
-                bot.send_message(call.message.chat.id, _("🤖 Whoops. Something went wrong"),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, _("🤖 Whoops. Something went wrong"), reply_markup=get_keyboard("back"))
         case "upd_":
-            bot.send_message(call.message.chat.id, _("🤖 Please provide the updated task"))
+            navigator.show(call.message, _("🤖 Please provide the updated task"))
             bot.register_next_step_handler(call.message, update_user_task, task_id=task_id)
 
 
@@ -322,6 +316,7 @@ def crud_handler(call: types.CallbackQuery) -> None:
     Handles actions after picking the date in main menu for CRUD operations. In "read" operation crud.view_tasks
     function is called to generate the list of user tasks by date and send it to user. In "delete" and "update"
     operations utils.get_task_list function is called to generate inline keyboard markup with user tasks by date.
+    The operation is defined by dialog state of the user in the chat set in main.basic_menu_handler.
     Args:
         call: Callback query.
 
@@ -329,7 +324,6 @@ def crud_handler(call: types.CallbackQuery) -> None:
         None
     """
 
-    global CHOICE
     user = get_user(user_id=call.from_user.id)
     if user:
         locale = user.language
@@ -341,70 +335,164 @@ def crud_handler(call: types.CallbackQuery) -> None:
         bot.edit_message_text(_("🤖 Ok! Let's choose the date"), call.message.chat.id, call.message.message_id,
                               reply_markup=key)
     elif result:
-        bot.delete_message(call.message.chat.id, call.message.message_id)
-        match CHOICE:
+        match bot.get_state(call.from_user.id, call.message.chat.id):
             case "create":
-                bot.send_message(call.message.chat.id, _("🤖 Tell me, what you want to do this day?"))
-                bot.register_next_step_handler(call.message, add_user_task, date=result)
+                prompt_id = navigator.show(call.message, _("🤖 Tell me, what you want to do this day?"))
+                bot.register_next_step_handler(call.message, add_user_task, date=result, prompt_id=prompt_id)
             case "read":
-                bot.send_message(call.message.chat.id, view_tasks(user_id=call.from_user.id, date=result),
-                                 reply_markup=get_keyboard("back"))
+                navigator.show(call.message, view_tasks(user_id=call.from_user.id, date=result),
+                               reply_markup=get_keyboard("back"))
             case "delete":
                 markup, have_tasks = get_task_list(user_id=call.from_user.id, date=result, prefix="del")
                 if have_tasks:
                     msg = _("🤖 Please choose the task to be deleted")
                 else:
                     msg = _("🤖 There are no tasks on that date!")
-                bot.send_message(call.message.chat.id, msg,
-                                 reply_markup=markup)
+                navigator.show(call.message, msg, reply_markup=markup)
             case "update":
                 markup, have_tasks = get_task_list(user_id=call.from_user.id, date=result, prefix="upd")
                 if have_tasks:
                     msg = _("🤖 Please choose the task to be updated")
                 else:
                     msg = _("🤖 There are no tasks on that date!")
-                bot.send_message(call.message.chat.id, msg,
-                                 reply_markup=markup)
+                navigator.show(call.message, msg, reply_markup=markup)
+
 
+def send_notification() -> MailingStats:
+    """
+    Send messages via mailing list generated by calling utils.get_send_list function. Messages are sent concurrently
+    by dispatcher.NotificationDispatcher as soon as they are generated. Every message is written to notifications
+    ledger (outbox.NotificationOutbox) before sending, so the messages already delivered in current slot are skipped.
+    After mailing the next notification time of notified users is moved forward by utils.update_next_fire.
+    Returns:
+        Mailing statistics.
+    """
 
-def send_notification() -> None:
+    utc_now = datetime.datetime.utcnow()
+    outbox = NotificationOutbox(mailing_session, get_slot(utc_now), batch_size=MAILING_BATCH_SIZE)
+    try:
+        outbox.purge()
+        outbox.abandon_stale()
+        logger.info(f"Starting mailing for slot {outbox.slot}")
+        dispatcher = NotificationDispatcher(bot, concurrency=MAILING_CONCURRENCY, rate_limit=MAILING_RATE_LIMIT)
+        stats = dispatcher.dispatch(outbox.write(get_send_list(utc_now)), on_sent=outbox.mark_sent,
+                                    on_failed=outbox.mark_failed)
+        outbox.flush()
+        update_next_fire(utc_now)
+    finally:
+        mailing_session.remove()
+    metrics.observe_mailing(stats)
+    logger.info(f"Mailing finished. {stats}")
+    return stats
+
+
+def resume_notification() -> None:
     """
-    Send messages via mailing list generated by calling utils.get_send_list function.
+    Sends notifications of the current slot which were written to notifications ledger but not delivered, f.e. if the
+    process was stopped in the middle of mailing and started again within the same hour. Undelivered notifications of
+    past slots are abandoned, as they are stale for their recipients.
     Returns:
         None
     """
 
-    send_list = get_send_list()
-    logger.info(f"Starting mailing. Found {len(send_list)} relevant users")
-    for user, user_tasks in send_list.items():
-        try:
-            bot.send_message(user, user_tasks)
-        except ApiTelegramException as e:
-            if e.description == "Forbidden: bot was blocked by the user":
-                logger.error(f"Attention! User {user} has blocked the bot.")
-        logger.info(f"Notification successfully sent to {user}")
+    outbox = NotificationOutbox(mailing_session, get_slot(), batch_size=MAILING_BATCH_SIZE)
+    try:
+        if abandoned := outbox.abandon_stale():
+            logger.warning(f"{abandoned} undelivered notifications of past slots abandoned")
+        dispatcher = NotificationDispatcher(bot, concurrency=MAILING_CONCURRENCY, rate_limit=MAILING_RATE_LIMIT)
+        stats = dispatcher.dispatch(outbox.pending(), on_sent=outbox.mark_sent, on_failed=outbox.mark_failed)
+        outbox.flush()
+    finally:
+        mailing_session.remove()
+    if stats.sent or stats.failed:
+        metrics.observe_mailing(stats)
+        logger.info(f"Interrupted mailing for slot {outbox.slot} resumed. {stats}")
 
 
 def schedule_checker() -> None:
     """
-    Worker for checking if notification time has come.
+    Worker for checking if notification time has come. Interrupted mailings are resumed first in the same thread, so
+    the resumed and the scheduled mailings never read the same undelivered notifications at the same time.
     Returns:
         None
     """
 
+    try:
+        resume_notification()
+    except Exception as e:
+        # Scheduled mailings are run even if the interrupted ones can't be resumed.
+        logger.exception("Resuming interrupted mailing failed")
+        report_error(e)
     while True:
-        time.sleep(schedule.idle_seconds())
+        # Idle time is negative if the mailing took longer than the period between mailings.
+        time.sleep(max(0, schedule.idle_seconds()))
         schedule.run_pending()
 
 
-if __name__ == "__main__":
-    Base.metadata.create_all()
-    admin_logger_client = TelegramClient(TOKEN)
-    schedule.every(int(NOTIFICATION_FREQUENCY)).hours.at(":00").do(send_notification)
-    while True:
+def send_to_admin(text: str) -> None:
+    """
+    Sends the message to bot admin.
+    Args:
+        text: Message text.
+
+    Returns:
+        None
+    """
+
+    admin_logger_client.post(method="sendMessage", params={"chat_id": ADMIN_CHAT_ID, "text": text})
+
+
+def report_error(error: Exception) -> None:
+    """
+    Adds the error to the digest sent to bot admin.
+    Args:
+        error: Raised exception.
+
+    Returns:
+        None
+    """
+
+    error_digest.add(error)
+
+
+def receive_updates() -> None:
+    """
+    Receives updates from Telegram and passes them to handlers. In "webhook" mode the webhook is set and updates are
+    received by webhook.WebhookServer, else the webhook is removed and updates are received by long polling.
+    Returns:
+        None
+    """
+
+    if UPDATE_MODE == "webhook":
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        server = WebhookServer(bot, secret_token=WEBHOOK_SECRET, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                               path=WEBHOOK_PATH, on_error=report_error)
         try:
-            threading.Thread(target=schedule_checker).start()
-            bot.polling()
-        except Exception as e:
-            log_message = f"{datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S')} : {e.__class__}\n{e}"
-            admin_logger_client.post(method="sendMessage", params={"chat_id": ADMIN_CHAT_ID, "text": log_message})
+            server.serve_forever()
+        finally:
+            server.stop()
+    else:
+        bot.remove_webhook()
+        bot.polling()
+
+
+if __name__ == "__main__":
+    migrate()
+    timezones.warm()
+    admin_logger_client = TelegramClient(TOKEN, session=http_session,
+                                         timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    error_digest = ErrorDigest(send_to_admin, interval=ERROR_DIGEST_INTERVAL)
+    if METRICS_PORT:
+        MetricsServer(metrics, host=METRICS_HOST, port=METRICS_PORT).start()
+    if bot.executor is not None:
+        bot.executor.on_error = report_error
+    if RUNTIME == "asyncio":
+        import asyncio
+        from aio import AsyncRuntime
+        asyncio.run(AsyncRuntime(bot, on_error=report_error).run())
+    else:
+        schedule.every(int(NOTIFICATION_FREQUENCY)).hours.at(":00").do(send_notification)
+        supervisor = Supervisor(on_error=report_error, max_backoff=WORKER_MAX_BACKOFF)
+        supervisor.add("updates", receive_updates)
+        supervisor.add("scheduler", schedule_checker)
+        supervisor.run()
@@ -0,0 +1,353 @@
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import aiohttp
+import requests
+import sqlalchemy.engine
+from typing import Callable, Iterator
+from sqlalchemy import event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger("bot")
+
+# Default histogram buckets in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value) -> str:
+    """
+    Escapes label value for Prometheus text format.
+    Args:
+        value: Label value.
+
+    Returns:
+        Escaped value.
+    """
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    """
+    Formats labels of the sample in Prometheus text format.
+    Args:
+        names: Label names.
+        values: Label values.
+        extra: Formatted label added after the others, f.e. 'le="0.1"'.
+
+    Returns:
+        Labels in curly brackets or empty string if there are no labels.
+    """
+
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """
+    Monotonically increasing value per label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Counter):
+    """
+    Value per label values which can go up and down.
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, *labels) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram:
+    """
+    Distribution of observed values per label values: number of values in every bucket, their sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # Label values as key, list of bucket counts (the last one is +Inf), sum and count as value.
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.values.items()]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = format_labels(self.labels, labels, 'le="' + le + '"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {count}"
+
+
+class BotMetrics:
+    """
+    Metrics of the bot: update and handler latency, database queries per update, Bot API calls and mailings.
+    Recording is a few dict updates under a lock, so metrics are always collected and exposed by MetricsServer.
+    """
+
+    def __init__(self):
+        self.updates = Histogram("bot_update_duration_seconds", "Update processing time by update type.", ("type",))
+        self.handlers = Histogram("bot_handler_duration_seconds", "Handler execution time by handler.", ("handler",))
+        self.handler_errors = Counter("bot_handler_errors_total", "Handler errors by handler.", ("handler",))
+        self.update_queries = Histogram("bot_update_db_queries", "Database queries per update by update type.",
+                                        ("type",), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+        self.update_db_time = Histogram("bot_update_db_seconds", "Database time per update by update type.",
+                                        ("type",))
+        self.queries = Histogram("bot_db_query_duration_seconds", "Database query time.")
+        self.api_calls = Histogram("bot_api_request_duration_seconds", "Bot API call time by method.", ("method",))
+        self.api_responses = Counter("bot_api_responses_total", "Bot API responses by method and HTTP status code.",
+                                     ("method", "code"))
+        self.mailings = Histogram("bot_mailing_duration_seconds", "Mailing duration.",
+                                  buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600))
+        self.notifications = Counter("bot_notifications_total", "Notifications by result.", ("result",))
+        self.mailing_size = Gauge("bot_mailing_last_size", "Notifications in the last mailing.")
+        self.mailing_rate = Gauge("bot_mailing_last_rate", "Send rate of the last mailing in messages per second.")
+        self.metrics = [self.updates, self.handlers, self.handler_errors, self.update_queries, self.update_db_time,
+                        self.queries, self.api_calls, self.api_responses, self.mailings, self.notifications,
+                        self.mailing_size, self.mailing_rate]
+        # Queries of the update being processed by the current thread: [count, time].
+        self.current = threading.local()
+
+    @contextlib.contextmanager
+    def track_update(self, update_type: str) -> Iterator[None]:
+        """
+        Observes processing time and database queries of the update processed in the block.
+        Args:
+            update_type: Update type, f.e. "message" or "callback_query".
+
+        Returns:
+            Context manager.
+        """
+
+        self.current.queries = queries = [0, 0.0]
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.updates.observe(time.perf_counter() - started_at, update_type)
+            self.current.queries = None
+            self.update_queries.observe(queries[0], update_type)
+            self.update_db_time.observe(queries[1], update_type)
+
+    def wrap_handler(self, function: Callable) -> Callable:
+        """
+        Wraps the handler to observe its execution time and errors.
+        Args:
+            function: Handler function.
+
+        Returns:
+            Wrapped function.
+        """
+
+        name = function.__name__
+
+        def handler(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.handler_errors.inc(name)
+                raise
+            finally:
+                self.handlers.observe(time.perf_counter() - started_at, name)
+
+        handler.__name__ = name
+        handler.__wrapped__ = function
+        return handler
+
+    def instrument_engine(self, engine: sqlalchemy.engine.Engine) -> None:
+        """
+        Observes all queries of the engine.
+        Args:
+            engine: Sqlalchemy engine.
+
+        Returns:
+            None
+        """
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+            context.query_started_at = time.perf_counter()
+
+        def after_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+            duration = time.perf_counter() - context.query_started_at
+            self.queries.observe(duration)
+            queries = getattr(self.current, "queries", None)
+            if queries is not None:
+                queries[0] += 1
+                queries[1] += duration
+
+        event.listen(engine, "before_cursor_execute", before_execute)
+        event.listen(engine, "after_cursor_execute", after_execute)
+
+    def instrument_http_session(self, session: requests.Session) -> None:
+        """
+        Observes Bot API calls made by the session.
+        Args:
+            session: HTTP session.
+
+        Returns:
+            None
+        """
+
+        def on_response(response: requests.Response, *args, **kwargs) -> None:
+            # URL ends with Bot API method, the token in the path isn't used.
+            method = response.request.path_url.split("?", 1)[0].rsplit("/", 1)[-1]
+            self.api_calls.observe(response.elapsed.total_seconds(), method)
+            self.api_responses.inc(method, str(response.status_code))
+
+        session.hooks["response"].append(on_response)
+
+    def get_trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Creates aiohttp trace config observing Bot API calls of the sessions created with it, f.e. the sessions of
+        AsyncTeleBot in asyncio runtime.
+
+        Returns:
+            Trace config.
+        """
+
+        async def on_request_start(session: aiohttp.ClientSession, context, params: aiohttp.TraceRequestStartParams) \
+                -> None:
+            context.started_at = time.perf_counter()
+
+        async def on_request_end(session: aiohttp.ClientSession, context, params: aiohttp.TraceRequestEndParams) \
+                -> None:
+            # URL ends with Bot API method, the token in the path isn't used.
+            method = params.url.path.rsplit("/", 1)[-1]
+            self.api_calls.observe(time.perf_counter() - context.started_at, method)
+            self.api_responses.inc(method, str(params.response.status))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def observe_mailing(self, stats) -> None:
+        """
+        Saves statistics of the finished mailing.
+        Args:
+            stats: Mailing statistics (dispatcher.MailingStats).
+
+        Returns:
+            None
+        """
+
+        self.mailings.observe(stats.duration)
+        self.notifications.inc("sent", amount=stats.sent)
+        self.notifications.inc("failed", amount=stats.failed)
+        self.notifications.inc("retried", amount=stats.retries)
+        self.mailing_size.set(stats.sent + stats.failed)
+        self.mailing_rate.set(stats.throughput)
+
+    def render(self) -> str:
+        """
+        Renders all the metrics in Prometheus text format.
+        Returns:
+            Metrics text.
+        """
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    HTTP server exposing the metrics in Prometheus text format on "path" in a background thread.
+    """
+
+    def __init__(self, metrics: BotMetrics, host: str = "127.0.0.1", port: int = 8000, path: str = "/metrics"):
+        self.metrics = metrics
+        self.path = path
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    @property
+    def address(self) -> tuple[str, int]:
+        """
+        Host and port the server is listening on.
+        """
+
+        return self.server.server_address[:2]
+
+    def start(self) -> "MetricsServer":
+        logger.info(f"Metrics server is listening on {self.address[0]}:{self.address[1]}{self.path}")
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] != server.path:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = server.metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
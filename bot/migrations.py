@@ -0,0 +1,134 @@
+import sqlalchemy.engine
+from sqlalchemy import inspect, text
+from models import Base, Users, ToDos, Outbox, DialogStates, GeocodeCache
+from loader import logger
+
+
+def add_columns(connection: sqlalchemy.engine.Connection, table: str, columns: dict) -> None:
+    """
+    Adds columns missing in the table.
+    Args:
+        connection: Database connection.
+        table: Table name.
+        columns: Dict with column name as key and its SQL definition as value.
+
+    Returns:
+        None
+    """
+
+    existing = {column["name"] for column in inspect(connection).get_columns(table)}
+    for name, definition in columns.items():
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+
+
+def create_indexes(connection: sqlalchemy.engine.Connection, model: type, *names: str) -> None:
+    """
+    Creates indexes declared in the model if they don't exist.
+    Args:
+        connection: Database connection.
+        model: Model class.
+        *names: Index names.
+
+    Returns:
+        None
+    """
+
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+
+def add_next_fire(connection: sqlalchemy.engine.Connection) -> None:
+    """
+    Adds the next notification time of users.
+    """
+
+    add_columns(connection, "users", {"next_fire_utc": "DATETIME"})
+
+
+def add_delivery_status(connection: sqlalchemy.engine.Connection) -> None:
+    """
+    Adds users delivery status and the index of users due to be notified.
+    """
+
+    add_columns(connection, "users", {
+        "delivery_status": "VARCHAR NOT NULL DEFAULT 'active'",
+        "failed_deliveries": "INTEGER NOT NULL DEFAULT 0",
+        "last_failure_at": "DATETIME",
+    })
+    create_indexes(connection, Users, "ix_users_delivery_status_next_fire_utc")
+
+
+def add_query_indexes(connection: sqlalchemy.engine.Connection) -> None:
+    """
+    Adds indexes of tasks by user and date and of users by timezone and notification time frame.
+    """
+
+    create_indexes(connection, ToDos, "ix_todos_user_id_todo_date")
+    create_indexes(connection, Users, "ix_users_timezone_notifications")
+
+
+def add_dialog_states(connection: sqlalchemy.engine.Connection) -> None:
+    """
+    Adds dialog states shared by bot processes.
+    """
+
+    DialogStates.__table__.create(connection, checkfirst=True)
+
+
+def add_geocode_cache(connection: sqlalchemy.engine.Connection) -> None:
+    """
+    Adds persistent cache of geocoding results.
+    """
+
+    GeocodeCache.__table__.create(connection, checkfirst=True)
+
+
+def add_outbox_abandoned_at(connection: sqlalchemy.engine.Connection) -> None:
+    """
+    Adds the time notification of a past slot was abandoned. Ledger created later is created from the model.
+    """
+
+    if inspect(connection).has_table(Outbox.__tablename__):
+        add_columns(connection, Outbox.__tablename__, {"abandoned_at": "DATETIME"})
+
+
+# Schema version of database is the number of applied migrations. New migrations must be appended to the end and
+# must be safe to run on partially migrated database.
+MIGRATIONS = [
+    add_next_fire,
+    add_delivery_status,
+    add_query_indexes,
+    add_dialog_states,
+    add_geocode_cache,
+    add_outbox_abandoned_at,
+]
+
+
+def migrate(engine: sqlalchemy.engine.Engine = None) -> int:
+    """
+    Brings database schema to the current version. New database is created from models, existing one is upgraded by
+    migrations which weren't applied yet. Schema version is stored in SQLite "user_version" pragma.
+    Args:
+        engine: Engine instance. Models engine is used if not passed.
+
+    Returns:
+        Schema version.
+    """
+
+    engine = engine or Base.metadata.bind
+    with engine.begin() as connection:
+        version = connection.execute(text("PRAGMA user_version")).scalar()
+        if version == 0 and not inspect(connection).has_table(Users.__tablename__):
+            version = len(MIGRATIONS)
+            logger.info(f"Creating database schema version {version}")
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Applying database migration {number}: {migration.__name__}")
+            migration(connection)
+            connection.execute(text(f"PRAGMA user_version = {number}"))
+
+        Base.metadata.create_all(connection)
+        connection.execute(text(f"PRAGMA user_version = {len(MIGRATIONS)}"))
+    return len(MIGRATIONS)
@@ -1,7 +1,7 @@
 import datetime
 from db import get_db
 from sqlalchemy.orm import relationship, declarative_base
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Time, Boolean
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, Time, Boolean, DateTime, Index, Float
 
 
 Base = declarative_base(bind=get_db())
@@ -13,6 +13,10 @@ class Users(Base):
     """
 
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_delivery_status_next_fire_utc", "delivery_status", "next_fire_utc"),
+        Index("ix_users_timezone_notifications", "timezone", "notifications_from", "notifications_to"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_user_id = Column(Integer, nullable=False, unique=True)
@@ -23,6 +27,11 @@ class Users(Base):
     notifications_from = Column(Time, nullable=False, default=datetime.datetime.strptime("09:00:00", "%H:%M:%S").time())
     notifications_to = Column(Time, nullable=False, default=datetime.datetime.strptime("20:00:00", "%H:%M:%S").time())
     muted = Column(Boolean, nullable=False, default=False)
+    next_fire_utc = Column(DateTime, nullable=True)
+    # "active", "blocked" (user has blocked the bot) or "deactivated" (user account or chat was deleted).
+    delivery_status = Column(String, nullable=False, default="active")
+    failed_deliveries = Column(Integer, nullable=False, default=0)
+    last_failure_at = Column(DateTime, nullable=True)
 
     user_todos = relationship("ToDos", backref="users", cascade="all")
 
@@ -33,8 +42,56 @@ class ToDos(Base):
     """
 
     __tablename__ = "todos"
+    __table_args__ = (Index("ix_todos_user_id_todo_date", "user_id", "todo_date"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey(Users.id), nullable=False)
     todo = Column(String, nullable=False)
     todo_date = Column(Date, nullable=False)
+
+
+class Outbox(Base):
+    """
+    Notifications ledger. Notification is written before sending and marked as sent after delivery, so the
+    interrupted mailing can be resumed without duplicates.
+    """
+
+    __tablename__ = "outbox"
+    __table_args__ = (Index("ix_outbox_slot_sent_at", "slot", "sent_at"),)
+
+    chat_id = Column(Integer, primary_key=True)
+    slot = Column(DateTime, primary_key=True)
+    message = Column(String, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    # Set if the notification wasn't delivered during its slot, such notifications are never sent.
+    abandoned_at = Column(DateTime, nullable=True)
+
+
+class DialogStates(Base):
+    """
+    Dialog state of the user in the chat. Used by state.SQLiteStateStorage to share states between bot processes.
+    """
+
+    __tablename__ = "dialog_states"
+
+    chat_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    state = Column(String, nullable=True)
+    # JSON encoded state data.
+    data = Column(String, nullable=False, default="{}")
+    expires_at = Column(DateTime, nullable=False)
+
+
+class GeocodeCache(Base):
+    """
+    Geocoding results by normalized city name. Used by geocoding.GeocodingCache. City which wasn't found is stored
+    without coordinates and timezone.
+    """
+
+    __tablename__ = "geocode_cache"
+
+    key = Column(String, primary_key=True)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    timezone = Column(String, nullable=True)
+    expires_at = Column(DateTime, nullable=False)
@@ -0,0 +1,61 @@
+import threading
+from collections import Counter
+from telebot import TeleBot, types
+from telebot.apihelper import ApiTelegramException
+
+
+class Navigator:
+    """
+    Shows the next menu screen after a button click. In "edit" mode the message with the clicked button is edited in
+    place (one API call), the message is deleted and the new one is sent only if it can't be edited (f.e. it's too
+    old). In "resend" mode the message is always deleted and the new one is sent (two API calls).
+    Bot API calls made by navigation are counted by method in "calls", failed edits - in "fallbacks".
+    """
+
+    def __init__(self, bot: TeleBot, mode: str = "edit"):
+        self.bot = bot
+        self.mode = mode
+        self.calls = Counter()
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def count(self, method: str) -> None:
+        with self.lock:
+            self.calls[method] += 1
+
+    def show(self, message: types.Message, text: str, reply_markup: types.InlineKeyboardMarkup | str = None,
+             parse_mode: str = None) -> int:
+        """
+        Replaces the message with the next screen.
+        Args:
+            message: Bot message with the clicked button.
+            text: Text of the next screen.
+            reply_markup: Inline keyboard of the next screen.
+            parse_mode: Text parse mode.
+
+        Returns:
+            ID of the message showing the screen.
+        """
+
+        if self.mode == "edit":
+            try:
+                self.bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=reply_markup,
+                                           parse_mode=parse_mode)
+                return message.message_id
+            except ApiTelegramException as e:
+                # The message already shows the same screen, f.e. after a double click.
+                if "message is not modified" in e.description:
+                    return message.message_id
+                with self.lock:
+                    self.fallbacks += 1
+            finally:
+                self.count("editMessageText")
+        self.count("deleteMessage")
+        try:
+            self.bot.delete_message(message.chat.id, message.message_id)
+        except ApiTelegramException:
+            # The message was deleted by user, the new one is sent anyway.
+            pass
+        self.count("sendMessage")
+        sent = self.bot.send_message(message.chat.id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return sent.message_id
@@ -0,0 +1,49 @@
+from typing import Iterable
+from i18n_class import I18N
+
+WELCOME_MSG = "🤖 Hello, {}! Today we are going to:\n"
+NO_TASKS_MSG = "🤖 Hello, {}! I'm glad to inform you that there are no scheduled tasks today!"
+TASK_LINE = "{}. {} \n"
+
+
+class NotificationRenderer:
+    """
+    Renders notification messages. The message templates are translated once per language found by I18N class,
+    so any new language added to translations directory is used in notifications automatically.
+    """
+
+    def __init__(self, i18n: I18N, default_language: str = "ru"):
+        self.default_language = default_language
+        self.templates = {
+            language: (i18n.gettext(WELCOME_MSG, language), i18n.gettext(NO_TASKS_MSG, language))
+            for language in i18n.available_translations
+        }
+
+    def render(self, language: str, user_name: str, tasks: list[str]) -> str:
+        """
+        Renders notification message.
+        Args:
+            language: User language.
+            user_name: Username in Telegram.
+            tasks: List of user tasks on local date.
+
+        Returns:
+            Notification message.
+        """
+
+        welcome_msg, no_tasks = self.templates.get(language) or self.templates[self.default_language]
+        if not tasks:
+            return no_tasks.format(user_name)
+        return welcome_msg.format(user_name) + "".join(TASK_LINE.format(i, task) for i, task in enumerate(tasks, 1))
+
+    def render_batch(self, users: Iterable[tuple[str, str, list[str]]]) -> list[str]:
+        """
+        Renders notification messages for several users at once.
+        Args:
+            users: Iterable of (language, username, tasks) tuples.
+
+        Returns:
+            List of notification messages.
+        """
+
+        return [self.render(language, user_name, tasks) for language, user_name, tasks in users]
@@ -0,0 +1,170 @@
+import datetime
+import threading
+from typing import Iterable, Iterator
+from itertools import islice
+from models import Outbox, Users
+from dispatcher import get_delivery_status
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert
+
+# Ledger records of older slots are purged.
+KEEP_SLOTS = datetime.timedelta(days=1)
+
+
+def get_slot(utc_now: datetime.datetime = None) -> datetime.datetime:
+    """
+    Returns mailing slot, i.e. the UTC hour the mailing belongs to.
+    Args:
+        utc_now: Current UTC time. If not passed, it is taken at the moment of calling.
+
+    Returns:
+        Mailing slot.
+    """
+
+    if utc_now is None:
+        utc_now = datetime.datetime.utcnow()
+    return utc_now.replace(minute=0, second=0, microsecond=0)
+
+
+class NotificationOutbox:
+    """
+    Notifications ledger of a single mailing slot. Notifications are written in batches before sending, delivered ones
+    are collected by "mark_sent" (which is safe to call from dispatcher workers) and saved with the next batch.
+    Delivery failures are collected by "mark_failed" and saved to users delivery status the same way.
+    All the database operations are performed in the thread consuming the mailing list.
+    """
+
+    def __init__(self, session: Session, slot: datetime.datetime, batch_size: int = 1000):
+        self.session = session
+        self.slot = slot
+        self.batch_size = batch_size
+        self.sent = []
+        self.failed = []
+        self.sent_lock = threading.Lock()
+
+    def write(self, send_list: Iterable[tuple[int, str]]) -> Iterator[tuple[int, str]]:
+        """
+        Writes notifications to ledger and skips ones that were already delivered in this slot.
+        Args:
+            send_list: Iterable of (chat ID, message) pairs.
+
+        Returns:
+            Iterator of (chat ID, message) pairs to be sent.
+        """
+
+        send_list = iter(send_list)
+        while batch := list(islice(send_list, self.batch_size)):
+            self.session.execute(
+                insert(Outbox).on_conflict_do_nothing(index_elements=["chat_id", "slot"]),
+                [{"chat_id": chat_id, "slot": self.slot, "message": message} for chat_id, message in batch]
+            )
+            delivered = {chat_id for (chat_id,) in self.session.query(Outbox.chat_id).filter(and_(
+                Outbox.slot == self.slot,
+                Outbox.sent_at.isnot(None),
+                Outbox.chat_id.in_([chat_id for chat_id, _ in batch])
+            ))}
+            self.flush()
+            yield from ((chat_id, message) for chat_id, message in batch if chat_id not in delivered)
+
+    def pending(self) -> Iterator[tuple[int, str]]:
+        """
+        Reads notifications of this slot which were written but not delivered to active users.
+
+        Returns:
+            Iterator of (chat ID, message) pairs to be sent.
+        """
+
+        last_chat_id = None
+        while True:
+            query = self.session.query(Outbox.chat_id, Outbox.message) \
+                .join(Users, Users.chat_id == Outbox.chat_id) \
+                .filter(and_(Outbox.slot == self.slot, Outbox.sent_at.is_(None), Outbox.abandoned_at.is_(None),
+                             Users.delivery_status == "active"))
+            if last_chat_id is not None:
+                query = query.filter(Outbox.chat_id > last_chat_id)
+            batch = query.order_by(Outbox.chat_id).limit(self.batch_size).all()
+            self.flush()
+            if not batch:
+                return
+            last_chat_id = batch[-1].chat_id
+            yield from ((chat_id, message) for chat_id, message in batch)
+
+    def mark_sent(self, chat_id: int) -> None:
+        """
+        Marks notification as delivered. The mark is saved to database by the next "flush" call.
+        Args:
+            chat_id: Chat ID in Telegram.
+
+        Returns:
+            None
+        """
+
+        with self.sent_lock:
+            self.sent.append(chat_id)
+
+    def mark_failed(self, chat_id: int, error: Exception) -> None:
+        """
+        Registers delivery failure. User delivery status is saved to database by the next "flush" call.
+        Args:
+            chat_id: Chat ID in Telegram.
+            error: Sending error.
+
+        Returns:
+            None
+        """
+
+        with self.sent_lock:
+            self.failed.append((chat_id, get_delivery_status(error)))
+
+    def flush(self) -> None:
+        """
+        Saves collected delivery marks and failures in one transaction.
+        Returns:
+            None
+        """
+
+        with self.sent_lock:
+            sent, self.sent = self.sent, []
+            failed, self.failed = self.failed, []
+        now = datetime.datetime.utcnow()
+        if sent:
+            self.session.query(Outbox) \
+                .filter(and_(Outbox.slot == self.slot, Outbox.chat_id.in_(sent))) \
+                .update({Outbox.sent_at: now}, synchronize_session=False)
+        for status in {status for chat_id, status in failed}:
+            self.session.query(Users) \
+                .filter(Users.chat_id.in_([chat_id for chat_id, chat_status in failed if chat_status == status])) \
+                .update({Users.delivery_status: status, Users.failed_deliveries: Users.failed_deliveries + 1,
+                         Users.last_failure_at: now}, synchronize_session=False)
+        self.session.commit()
+
+    def abandon_stale(self) -> int:
+        """
+        Marks notifications of the slots before this one which were written but not delivered as abandoned. The message
+        was rendered for the recipient's notification window and local date at its slot hour, so it must not be sent
+        later, f.e. when the process stopped in the middle of mailing is started again in the next hours.
+
+        Returns:
+            Number of abandoned notifications.
+        """
+
+        abandoned = self.session.query(Outbox) \
+            .filter(and_(Outbox.slot < self.slot, Outbox.sent_at.is_(None), Outbox.abandoned_at.is_(None))) \
+            .update({Outbox.abandoned_at: datetime.datetime.utcnow()}, synchronize_session=False)
+        self.session.commit()
+        return abandoned
+
+    def purge(self, keep: datetime.timedelta = KEEP_SLOTS) -> int:
+        """
+        Deletes ledger records of old slots.
+        Args:
+            keep: Age of slots to keep.
+
+        Returns:
+            Number of deleted records.
+        """
+
+        deleted = self.session.query(Outbox).filter(Outbox.slot < self.slot - keep).delete(synchronize_session=False)
+        self.session.commit()
+        return deleted
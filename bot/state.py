@@ -0,0 +1,222 @@
+import abc
+import json
+import time
+import datetime
+import threading
+import sqlalchemy.engine
+from sqlalchemy import and_, case, bindparam, select, update, delete
+from sqlalchemy.dialects.sqlite import insert
+from telebot.storage.base_storage import StateStorageBase, StateContext
+from models import Base, DialogStates
+
+
+class TTLStateStorage(StateStorageBase, abc.ABC):
+    """
+    Base class of dialog state storages. States expire if they weren't changed during "ttl" seconds, expired states
+    are removed not more often than every "purge_interval" seconds.
+    """
+
+    def __init__(self, ttl: float = 3600, purge_interval: float = 60):
+        super().__init__()
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.purged_at = time.monotonic()
+
+    def maybe_purge(self) -> None:
+        """
+        Removes expired states if "purge_interval" has passed since the last purge.
+        Returns:
+            None
+        """
+
+        now = time.monotonic()
+        if now - self.purged_at >= self.purge_interval:
+            self.purged_at = now
+            self.purge()
+
+    @abc.abstractmethod
+    def purge(self) -> int:
+        """
+        Removes expired states. Implemented by storages.
+        Returns:
+            Number of removed states.
+        """
+
+    def get_interactive_data(self, chat_id: int, user_id: int) -> StateContext:
+        return StateContext(self, chat_id, user_id)
+
+
+class MemoryStateStorage(TTLStateStorage):
+    """
+    Thread-safe in-memory dialog state storage. The states are kept by (chat ID, user ID) of the process, so it can
+    be used by single bot process only.
+    """
+
+    def __init__(self, ttl: float = 3600, purge_interval: float = 60):
+        super().__init__(ttl, purge_interval)
+        # {(chat_id, user_id): {"state": state, "data": {}, "expires_at": monotonic time}}
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def get_record(self, chat_id: int, user_id: int) -> dict | None:
+        record = self.states.get((chat_id, user_id))
+        if record is None or record["expires_at"] <= time.monotonic():
+            return None
+        return record
+
+    def set_state(self, chat_id: int, user_id: int, state) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+        with self.lock:
+            record = self.get_record(chat_id, user_id)
+            if record is None:
+                record = self.states[(chat_id, user_id)] = {"state": state, "data": {}}
+            record["state"] = state
+            record["expires_at"] = time.monotonic() + self.ttl
+        self.maybe_purge()
+        return True
+
+    def get_state(self, chat_id: int, user_id: int):
+        with self.lock:
+            record = self.get_record(chat_id, user_id)
+            return record["state"] if record else None
+
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+        with self.lock:
+            return self.states.pop((chat_id, user_id), None) is not None
+
+    def get_data(self, chat_id: int, user_id: int) -> dict | None:
+        with self.lock:
+            record = self.get_record(chat_id, user_id)
+            return record["data"] if record else None
+
+    def reset_data(self, chat_id: int, user_id: int) -> bool:
+        return self.save(chat_id, user_id, {})
+
+    def set_data(self, chat_id: int, user_id: int, key: str, value) -> bool:
+        with self.lock:
+            record = self.get_record(chat_id, user_id)
+            if record is None:
+                raise RuntimeError(f"chat_id {chat_id} and user_id {user_id} does not exist")
+            record["data"][key] = value
+            record["expires_at"] = time.monotonic() + self.ttl
+            return True
+
+    def save(self, chat_id: int, user_id: int, data: dict) -> bool:
+        with self.lock:
+            record = self.get_record(chat_id, user_id)
+            if record is None:
+                return False
+            record["data"] = data
+            record["expires_at"] = time.monotonic() + self.ttl
+            return True
+
+    def purge(self) -> int:
+        """
+        Removes expired states.
+        Returns:
+            Number of removed states.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, record in self.states.items() if record["expires_at"] <= now]
+            for key in expired:
+                del self.states[key]
+        return len(expired)
+
+
+class SQLiteStateStorage(TTLStateStorage):
+    """
+    Dialog state storage in "dialog_states" table of bot database, so the states are shared by several bot processes
+    using the same database. State data must be JSON serializable. Every operation is a single statement by primary
+    key (chat ID, user ID).
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine = None, ttl: float = 3600, purge_interval: float = 60):
+        super().__init__(ttl, purge_interval)
+        self.engine = engine or Base.metadata.bind
+        # Statements are built once and executed with parameters, so lookups skip statement construction.
+        table = DialogStates.__table__
+        key = and_(table.c.chat_id == bindparam("chat"), table.c.user_id == bindparam("user"))
+        alive = and_(key, table.c.expires_at > bindparam("now"))
+        upsert = insert(table).values(chat_id=bindparam("chat"), user_id=bindparam("user"),
+                                      state=bindparam("new_state"), data="{}", expires_at=bindparam("expires"))
+        # Data of expired state is reset as if the state didn't exist.
+        self.upsert_state = upsert.on_conflict_do_update(
+            index_elements=[table.c.chat_id, table.c.user_id],
+            set_={"state": upsert.excluded.state, "expires_at": upsert.excluded.expires_at,
+                  "data": case((table.c.expires_at > bindparam("now"), table.c.data), else_="{}")},
+        )
+        self.select_state = select(table.c.state).where(alive)
+        self.select_data = select(table.c.data).where(alive)
+        self.update_data = update(table).where(alive).values(data=bindparam("new_data"),
+                                                             expires_at=bindparam("expires"))
+        self.delete_key = delete(table).where(key)
+        self.delete_expired = delete(table).where(table.c.expires_at <= bindparam("now"))
+
+    def params(self, chat_id: int, user_id: int, **kwargs) -> dict:
+        """
+        Returns statement parameters of the state.
+        Args:
+            chat_id: Chat ID.
+            user_id: User ID.
+            **kwargs: Other parameters.
+
+        Returns:
+            Dict of parameters.
+        """
+
+        now = datetime.datetime.utcnow()
+        return {"chat": chat_id, "user": user_id, "now": now, "expires": now + datetime.timedelta(seconds=self.ttl)} \
+            | kwargs
+
+    def set_state(self, chat_id: int, user_id: int, state) -> bool:
+        if hasattr(state, "name"):
+            state = state.name
+        with self.engine.begin() as connection:
+            connection.execute(self.upsert_state, self.params(chat_id, user_id, new_state=state))
+        self.maybe_purge()
+        return True
+
+    def get_state(self, chat_id: int, user_id: int):
+        with self.engine.connect() as connection:
+            return connection.execute(self.select_state, self.params(chat_id, user_id)).scalar()
+
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+        with self.engine.begin() as connection:
+            return connection.execute(self.delete_key, self.params(chat_id, user_id)).rowcount > 0
+
+    def get_data(self, chat_id: int, user_id: int) -> dict | None:
+        with self.engine.connect() as connection:
+            data = connection.execute(self.select_data, self.params(chat_id, user_id)).scalar()
+        return json.loads(data) if data is not None else None
+
+    def reset_data(self, chat_id: int, user_id: int) -> bool:
+        return self.save(chat_id, user_id, {})
+
+    def set_data(self, chat_id: int, user_id: int, key: str, value) -> bool:
+        params = self.params(chat_id, user_id)
+        with self.engine.begin() as connection:
+            data = connection.execute(self.select_data, params).scalar()
+            if data is None:
+                raise RuntimeError(f"chat_id {chat_id} and user_id {user_id} does not exist")
+            data = json.loads(data)
+            data[key] = value
+            connection.execute(self.update_data, params | {"new_data": json.dumps(data)})
+        return True
+
+    def save(self, chat_id: int, user_id: int, data: dict) -> bool:
+        with self.engine.begin() as connection:
+            return connection.execute(self.update_data,
+                                      self.params(chat_id, user_id, new_data=json.dumps(data))).rowcount > 0
+
+    def purge(self) -> int:
+        """
+        Removes expired states.
+        Returns:
+            Number of removed states.
+        """
+
+        with self.engine.begin() as connection:
+            return connection.execute(self.delete_expired, {"now": datetime.datetime.utcnow()}).rowcount
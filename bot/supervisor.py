@@ -0,0 +1,197 @@
+import time
+import random
+import logging
+import datetime
+import threading
+from typing import Callable
+
+logger = logging.getLogger("bot")
+
+
+class Supervisor:
+    """
+    Runs every worker in its own thread and restarts it when it fails or stops, so there is always exactly one thread
+    of each worker. Restarts are delayed with jittered exponential backoff, the delay is reset once the worker has been
+    running for "stable_after" seconds. Worker errors are reported by "on_error" callback.
+    """
+
+    def __init__(self, on_error: Callable[[Exception], None] = None, backoff: float = 1.0, max_backoff: float = 300.0,
+                 stable_after: float = 60.0):
+        self.on_error = on_error
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.workers = {}
+        self.restarts = {}
+        self.stopping = threading.Event()
+
+    def add(self, name: str, target: Callable[[], None]) -> None:
+        """
+        Adds the worker. Must be called before "run".
+        Args:
+            name: Worker name, used as thread name.
+            target: Callable running the worker until it fails.
+
+        Returns:
+            None
+        """
+
+        self.workers[name] = target
+        self.restarts[name] = 0
+
+    def get_delay(self, failures: int) -> float:
+        """
+        Calculates the delay before the next restart.
+        Args:
+            failures: Number of failures in a row.
+
+        Returns:
+            Delay in seconds.
+        """
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    def supervise(self, name: str) -> None:
+        """
+        Runs the worker and restarts it until the supervisor is stopped.
+        Args:
+            name: Worker name.
+
+        Returns:
+            None
+        """
+
+        target = self.workers[name]
+        failures = 0
+        while not self.stopping.is_set():
+            started_at = time.monotonic()
+            try:
+                target()
+                logger.warning(f"Worker {name} stopped")
+            except Exception as e:
+                logger.exception(f"Worker {name} failed")
+                if self.on_error is not None:
+                    self.on_error(e)
+            if time.monotonic() - started_at >= self.stable_after:
+                failures = 0
+            failures += 1
+            delay = self.get_delay(failures)
+            logger.info(f"Restarting worker {name} in {delay:.1f}s")
+            if self.stopping.wait(delay):
+                break
+            self.restarts[name] += 1
+
+    def run(self) -> None:
+        """
+        Starts the workers and waits for them until the supervisor is stopped.
+        Returns:
+            None
+        """
+
+        threads = [threading.Thread(target=self.supervise, args=(name,), name=name, daemon=True)
+                   for name in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self) -> None:
+        """
+        Stops restarting the workers. Running workers must be stopped by the caller.
+        Returns:
+            None
+        """
+
+        self.stopping.set()
+
+
+class ErrorDigest:
+    """
+    Collects errors and sends them to bot admin as a digest once per "interval" seconds instead of one message per
+    error. Errors with the same class and text are counted together with the time they were first and last seen, so
+    an error storm costs one message per interval.
+    """
+
+    def __init__(self, send: Callable[[str], None], interval: float = 60.0, max_kinds: int = 10):
+        self.send = send
+        self.interval = interval
+        # Kinds of errors listed in the digest, the rest are only counted.
+        self.max_kinds = max_kinds
+        self.errors = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve, name="error-digest", daemon=True)
+        self.thread.start()
+
+    def add(self, error: Exception) -> None:
+        """
+        Adds the error to the next digest.
+        Args:
+            error: Raised exception.
+
+        Returns:
+            None
+        """
+
+        key = (error.__class__.__name__, str(error)[:300])
+        now = datetime.datetime.now()
+        with self.lock:
+            entry = self.errors.get(key)
+            if entry is not None:
+                entry["count"] += 1
+                entry["last_seen"] = now
+            elif len(self.errors) < self.max_kinds:
+                self.errors[key] = {"count": 1, "first_seen": now, "last_seen": now}
+            else:
+                self.dropped += 1
+
+    def render(self, errors: dict, dropped: int) -> str:
+        """
+        Generates the digest message.
+        Args:
+            errors: Dict with (class name, text) as key and the count, first and last seen time as value.
+            dropped: Number of errors of unlisted kinds.
+
+        Returns:
+            Digest message.
+        """
+
+        time_format = "%Y-%m-%d %H-%M-%S"
+        lines = [f"{sum(entry['count'] for entry in errors.values()) + dropped} errors:"]
+        for (name, text), entry in sorted(errors.items(), key=lambda item: -item[1]["count"]):
+            lines.append(f"{entry['count']} x {name}: {text}\n"
+                         f"first seen {entry['first_seen'].strftime(time_format)}, "
+                         f"last seen {entry['last_seen'].strftime(time_format)}")
+        if dropped:
+            lines.append(f"{dropped} errors of other kinds")
+        return "\n\n".join(lines)
+
+    def flush(self) -> None:
+        """
+        Sends the collected errors, if any, and starts the next digest.
+        Returns:
+            None
+        """
+
+        with self.lock:
+            errors, dropped = self.errors, self.dropped
+            self.errors, self.dropped = {}, 0
+        if not errors and not dropped:
+            return
+        try:
+            self.send(self.render(errors, dropped))
+        except Exception:
+            # The digest isn't resent, so a failing admin chat doesn't make the storm worse.
+            logger.exception("Can't send error digest to bot admin")
+
+    def serve(self) -> None:
+        """
+        Sends digests until the process exits.
+        Returns:
+            None
+        """
+
+        while True:
+            time.sleep(self.interval)
+            self.flush()
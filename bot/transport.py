@@ -0,0 +1,42 @@
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class JitteredRetry(Retry):
+    """
+    Retry policy with exponential backoff and random jitter, so the workers failed at the same time don't retry at the
+    same time too.
+    """
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) + backoff / 2 if backoff else 0
+
+
+def get_http_session(pool_size: int = 10, retries: int = 3, backoff: float = 0.5) -> requests.Session:
+    """
+    Creates HTTP session shared by all the threads calling Telegram API. Connections are kept alive and reused from the
+    pool of "pool_size" connections per host. Failed connections are retried with jittered backoff. Gateway errors
+    (502/503/504) are retried for GET requests only: telebot sends idempotent methods (getUpdates, getMe, setWebhook)
+    by GET and the rest by POST, and a gateway error may come after Telegram has already sent the message. Read
+    timeouts aren't retried for the same reason, and 429 responses are handled by the caller
+    (dispatcher.NotificationDispatcher pauses the whole mailing).
+    Args:
+        pool_size: Maximum number of kept alive connections per host.
+        retries: Maximum number of retries of the request.
+        backoff: Backoff factor in seconds, the delay before n-th retry is about backoff * 2 ** (n - 1).
+
+    Returns:
+        Session instance.
+    """
+
+    retry = JitteredRetry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+                          status_forcelist=(502, 503, 504), allowed_methods=frozenset(("GET",)),
+                          raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -1,14 +1,16 @@
 import pytz
-import geopy
 import datetime
+from itertools import groupby
 from loader import logger
 from crud import get_tasks
-from geopy import Location
-from loader import _, session
+from typing import Iterator
+from loader import _, session, mailing_session, renderer, user_cache, geocoding, writer, MAILING_BATCH_SIZE
 from models import ToDos, Users
-from sqlalchemy import exc, and_
+from sqlalchemy import exc, and_, or_, case, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import ColumnElement
 from keyboards import get_keyboard
-from timezonefinder import TimezoneFinder
+from geocoding import Place
 from telebot.types import InlineKeyboardMarkup
 
 
@@ -48,116 +50,320 @@ def get_task_list(user_id: int, date: datetime.date, prefix: str) -> tuple[Inlin
         return markup, False
 
 
-def get_user(user_id: int) -> Users | None:
+def get_user(user_id: int, cached: bool = True) -> Users | None:
     """
-    Returns user object by specified user ID.
+    Returns user object by specified user ID. Users are cached in bounded LRU cache detached from the session, so
+    the user is read from database once and the same object is shared by middleware and handlers of the update. Any
+    function that changes the user must invalidate the cache.
     Args:
         user_id: User ID.
+        cached: If False, user is read from database and stays attached to the session to be updated.
 
     Returns:
         User object if found else None.
     """
 
+    if cached:
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+
     user = session.query(Users).filter(Users.telegram_user_id == user_id).one_or_none()
     if user:
+        if cached:
+            session.expunge(user)
+            user_cache.put(user_id, user)
         return user
     else:
         return None
 
 
-def get_user_date(timezone: str) -> datetime:
+def activate_user(user_id: int) -> bool:
+    """
+    Performs operations on database to reactivate the user who has blocked the bot before and then came back.
+    Args:
+        user_id: User ID.
+
+    Returns:
+        True if success else False.
+    """
+
+    def activate(write_session: Session) -> bool:
+        # Delivery status is changed by mailing, so it's read from database.
+        user = query_user(write_session, user_id)
+        if user is None or user.delivery_status == "active":
+            return False
+        user.delivery_status = "active"
+        user.failed_deliveries = 0
+        set_next_fire(user)
+        return True
+
+    try:
+        if writer.run(activate):
+            user_cache.invalidate(user_id)
+            logger.info(f"User {user_id} was reactivated")
+        return True
+    except exc.SQLAlchemyError:
+        logger.error(f"Database error while reactivating user {user_id}")
+        return False
+
+
+def query_user(write_session: Session, user_id: int) -> Users | None:
+    """
+    Reads user to be changed by write operation.
+    Args:
+        write_session: Session of write operation.
+        user_id: User ID.
+
+    Returns:
+        User object if found else None.
+    """
+
+    return write_session.query(Users).filter(Users.telegram_user_id == user_id).one_or_none()
+
+
+def get_user_date(timezone: str, utc_now: datetime.datetime = None) -> datetime:
     """
     Returns the exact date in user timezone according to provided timezone.
     Args:
         timezone: User timezone.
+        utc_now: Current UTC time. If not passed, it is taken at the moment of calling.
 
     Returns:
         Date in user timezone.
     """
 
-    source_date_with_timezone = pytz.timezone("Europe/London").localize(datetime.datetime.utcnow())
+    if utc_now is None:
+        utc_now = datetime.datetime.utcnow()
+    source_date_with_timezone = pytz.timezone("Europe/London").localize(utc_now)
     target_date_with_timezone = source_date_with_timezone.astimezone(pytz.timezone(timezone))
     return target_date_with_timezone
 
 
-def get_send_list() -> dict:
+def get_timezone_cohorts(utc_now: datetime.datetime, session: Session = None) -> dict:
+    """
+    Groups the distinct timezones of users due to be notified by the current local date and time, so the local time
+    is calculated once per timezone instead of once per user.
+    Args:
+        utc_now: Current UTC time.
+        session: Database session. Mailing session is used if not passed.
+
+    Returns:
+        Dictionary with local date and time (without tzinfo) as key and list of timezones as value.
+    """
+
+    session = session or mailing_session
+    cohorts = {}
+    for (timezone,) in session.query(Users.timezone).filter(is_notification_due(utc_now)).distinct():
+        local_datetime = get_user_date(timezone, utc_now=utc_now).replace(tzinfo=None)
+        cohorts.setdefault(local_datetime, []).append(timezone)
+    return cohorts
+
+
+def is_notification_time(notifications_from: datetime.time, notifications_to: datetime.time,
+                         user_time: datetime.time) -> bool:
+    """
+    Checks if the local time is inside user notification time frame. The stop time is extended by 2 minutes.
+    Args:
+        notifications_from: Start of user notification time frame.
+        notifications_to: Stop of user notification time frame.
+        user_time: Local time of user.
+
+    Returns:
+        True if user should be notified at this time else False.
+    """
+
+    return notifications_from <= user_time <= \
+        (datetime.datetime.combine(datetime.date.today(), notifications_to) + datetime.timedelta(minutes=2)).time()
+
+
+def get_next_fire(timezone: str, notifications_from: datetime.time, notifications_to: datetime.time,
+                  after: datetime.datetime) -> datetime.datetime:
+    """
+    Calculates the next mailing hour (in UTC) at which the user local time is inside the notification time frame.
+    If there is no such hour during the next day (f.e. the time frame is empty), the user is checked again a day later.
+    Args:
+        timezone: User timezone.
+        notifications_from: Start of user notification time frame.
+        notifications_to: Stop of user notification time frame.
+        after: UTC time the next mailing hour is searched from (inclusive).
+
+    Returns:
+        UTC time of the next notification.
+    """
+
+    hour = after.replace(minute=0, second=0, microsecond=0)
+    if hour < after:
+        hour += datetime.timedelta(hours=1)
+
+    # 25 hours cover the whole day even if DST shift happens.
+    for hours in range(25):
+        fire_at = hour + datetime.timedelta(hours=hours)
+        if is_notification_time(notifications_from, notifications_to,
+                                get_user_date(timezone, utc_now=fire_at).time()):
+            return fire_at
+    return hour + datetime.timedelta(hours=25)
+
+
+def is_notification_due(utc_now: datetime.datetime) -> ColumnElement:
     """
-    Generates dict of actual users to send notifications to.
+    Generates SQL condition selecting users whose next notification time has come. Users without calculated next
+    notification time (f.e. new ones) are always due. Users who have blocked the bot or were deactivated are never due.
+    Args:
+        utc_now: Current UTC time.
 
     Returns:
-        Dictionary with user Telegram chat ID as key and user task list as value.
+        SQL condition.
     """
 
-    users = session.query(Users).all()
-    send_list = {}
+    return and_(Users.delivery_status == "active",
+                or_(Users.next_fire_utc.is_(None), Users.next_fire_utc <= utc_now))
 
-    for user in users:
-        target_date_with_timezone = get_user_date(user.timezone)
 
-        user_date = target_date_with_timezone.date()
-        user_time = target_date_with_timezone.time()
+def update_next_fire(utc_now: datetime.datetime, session: Session = None) -> None:
+    """
+    Moves the next notification time of all the due users to the next suitable hour after the current mailing.
+    The time is calculated once per distinct timezone and time frame and saved by one update per such group.
+    Args:
+        utc_now: UTC time of the current mailing.
+        session: Database session. Mailing session is used if not passed.
 
-        if user.notifications_from <= user_time <= \
-                (datetime.datetime.combine(datetime.date.today(), user.notifications_to)
-                 + datetime.timedelta(minutes=2)).time():
+    Returns:
+        None
+    """
 
-            tasks = session.query(ToDos.todo).filter(and_(ToDos.user_id == user.id, ToDos.todo_date == user_date)).all()
+    session = session or mailing_session
+    after = utc_now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    groups = session.query(Users.timezone, Users.notifications_from, Users.notifications_to) \
+        .filter(is_notification_due(utc_now)).distinct().all()
+    for timezone, notifications_from, notifications_to in groups:
+        session.query(Users) \
+            .filter(and_(is_notification_due(utc_now), Users.timezone == timezone,
+                         Users.notifications_from == notifications_from, Users.notifications_to == notifications_to)) \
+            .update({Users.next_fire_utc: get_next_fire(timezone, notifications_from, notifications_to, after)},
+                    synchronize_session=False)
+    session.commit()
 
-            welcome_msg = "🤖 Привет, {}! Сегодня у нас по плану: \n".format(user.telegram_user_name)
-            no_tasks = "🤖 Привет, {}! Я тут, чтобы сообщить, " \
-                       "что запланированных дел на сегодня нет!".format(user.telegram_user_name)
 
-            if user.language == "en":
-                welcome_msg = "🤖 Hello, {}! Today we are going to:\n".format(user.telegram_user_name)
-                no_tasks = "🤖 Hello, {}! I'm glad to inform you " \
-                           "that there are no scheduled tasks today!".format(user.telegram_user_name)
+def set_next_fire(user: Users) -> None:
+    """
+    Recalculates the next notification time of the user after changing its settings. It isn't committed here.
+    Args:
+        user: User object.
 
-            if len(tasks) != 0:
-                msg = welcome_msg
-                i = 1
-                for task in tasks:
-                    msg += f"{i}. {task[0]} \n"
-                    i += 1
-            else:
-                if not user.muted:
-                    msg = no_tasks
-                else:
-                    continue
-            send_list[user.chat_id] = msg
+    Returns:
+        None
+    """
 
-    return send_list
+    user.next_fire_utc = get_next_fire(user.timezone, user.notifications_from, user.notifications_to,
+                                       after=datetime.datetime.utcnow())
 
 
-def get_location(city: str) -> Location | None:
+def get_notification_window(user_time: datetime.time) -> ColumnElement:
     """
-    Returns user coordinates by provided city.
+    Generates SQL condition selecting users whose notification time frame includes provided local time. It is the
+    same as "notifications_from <= user_time <= notifications_to + 2 minutes", where the stop time wraps at midnight.
+    Args:
+        user_time: Local time of users.
+
+    Returns:
+        SQL condition.
+    """
+
+    wrap_start = datetime.time(23, 58)
+    threshold = (datetime.datetime.combine(datetime.date.today(), user_time) - datetime.timedelta(minutes=2)).time()
+
+    if user_time >= datetime.time(0, 2):
+        notifications_to = and_(Users.notifications_to >= threshold, Users.notifications_to < wrap_start)
+    else:
+        notifications_to = or_(Users.notifications_to >= threshold, Users.notifications_to < wrap_start)
+    return and_(Users.notifications_from <= user_time, notifications_to)
+
+
+def get_send_list(utc_now: datetime.datetime = None, session: Session = None) -> Iterator[tuple[int, str]]:
+    """
+    Generates actual users to send notifications to. Only users whose next notification time has come are selected
+    (see utils.update_next_fire). They are split into cohorts by timezone, so the notification time frame is checked
+    by database and only users inside their time frame are loaded. Users are read by pages of
+    MAILING_BATCH_SIZE users, and each page with users tasks on local date is fetched by a single query ordered by
+    user, so the tasks are grouped per chat in one pass. Messages of the page are rendered at once by
+    notifications.NotificationRenderer and yielded as soon as the page is ready.
+    No database cursor is left open between pages, so the notification ledger can be committed meanwhile.
+
+    Args:
+        utc_now: UTC time of the mailing. If not passed, it is taken at the moment of calling.
+        session: Database session. Mailing session is used if not passed.
+
+    Returns:
+        Iterator of user Telegram chat ID and user task list pairs.
+    """
+
+    session = session or mailing_session
+    if utc_now is None:
+        utc_now = datetime.datetime.utcnow()
+    cohorts = get_timezone_cohorts(utc_now, session)
+    if not cohorts:
+        return
+
+    in_window = and_(is_notification_due(utc_now),
+                     or_(*[and_(Users.timezone.in_(timezones), get_notification_window(local_datetime.time()))
+                           for local_datetime, timezones in cohorts.items()]))
+    local_date = case(*[(Users.timezone.in_(timezones), local_datetime.date())
+                        for local_datetime, timezones in cohorts.items()])
+    last_user_id = 0
+
+    while True:
+        page = select(Users.id).where(in_window, Users.id > last_user_id).order_by(Users.id).limit(MAILING_BATCH_SIZE)
+        rows = session.query(Users.id, Users.chat_id, Users.telegram_user_name, Users.language, Users.muted,
+                             ToDos.todo) \
+            .outerjoin(ToDos, and_(ToDos.user_id == Users.id, ToDos.todo_date == local_date)) \
+            .filter(Users.id.in_(page)) \
+            .order_by(Users.id, ToDos.id) \
+            .all()
+        session.commit()
+        if not rows:
+            return
+        last_user_id = rows[-1].id
+
+        users = []
+        for user_id, user_rows in groupby(rows, key=lambda row: row.id):
+            user_rows = list(user_rows)
+            user = user_rows[0]
+            tasks = [row.todo for row in user_rows if row.todo is not None]
+            if tasks or not user.muted:
+                users.append((user.chat_id, (user.language, user.telegram_user_name, tasks)))
+
+        messages = renderer.render_batch(user_info for chat_id, user_info in users)
+        yield from zip((chat_id for chat_id, user_info in users), messages)
+
+
+def get_location(city: str) -> Place | None:
+    """
+    Returns user coordinates and timezone by provided city. Geocoder is called only if the city isn't in geocoding
+    cache.
     Args:
         city: User city.
 
     Returns:
-        Location object if success, else None.
+        Place object if success, else None.
     """
 
-    geo = geopy.geocoders.Nominatim(user_agent="Notification_Bot")
-    location = geo.geocode(city)
-    return location
+    return geocoding.lookup(city)
 
 
-def get_timezone_by_location(location: Location) -> tuple[str, str]:
+def get_timezone_by_location(location: Place) -> tuple[str, str]:
     """
-    Returns timezone by provided coordinates.
+    Returns timezone and its current UTC offset of provided place.
     Args:
-        location: Location object.
+        location: Place object.
 
     Returns:
         Timezone and UTC offset.
     """
 
-    time_zone_finder = TimezoneFinder()
-    timezone_str = time_zone_finder.timezone_at(lng=location.longitude, lat=location.latitude)
-    offset = datetime.datetime.now(tz=pytz.timezone(timezone_str)).strftime("%z")
+    offset = datetime.datetime.now(tz=pytz.timezone(location.timezone)).strftime("%z")
     offset = offset[0:3] + ":" + offset[3:]
-    return timezone_str, offset
+    return location.timezone, offset
 
 
 def update_timezone(timezone_str: str, user_id: int) -> bool:
@@ -171,19 +377,23 @@ def update_timezone(timezone_str: str, user_id: int) -> bool:
         True if success else False.
     """
 
-    user = get_user(user_id=user_id)
-    if user:
-        try:
+    def update(write_session: Session) -> bool:
+        user = query_user(write_session, user_id)
+        if user:
             user.timezone = timezone_str
-            session.add(user)
-            session.commit()
-            logger.info(f"User {user.telegram_user_id} successfully changed timezone to {timezone_str}")
+            set_next_fire(user)
+        return user is not None
+
+    try:
+        if writer.run(update):
+            user_cache.invalidate(user_id)
+            logger.info(f"User {user_id} successfully changed timezone to {timezone_str}")
             return True
-        except exc.SQLAlchemyError:
-            logger.error(f"Database error while changing {user.telegram_user_id}'s timezone to {timezone_str}")
+        else:
+            logger.error(f"Can't find user with telegram ID {user_id} in DB while changing timezone to {timezone_str}")
             return False
-    else:
-        logger.error(f"Can't find user with telegram ID {user_id} in DB while changing timezone to {timezone_str}")
+    except exc.SQLAlchemyError:
+        logger.error(f"Database error while changing {user_id}'s timezone to {timezone_str}")
         return False
 
 
@@ -198,19 +408,22 @@ def set_language(language: str, user_id: int) -> bool:
         True if success else False.
     """
 
-    user = get_user(user_id=user_id)
-    if user:
-        try:
+    def update(write_session: Session) -> bool:
+        user = query_user(write_session, user_id)
+        if user:
             user.language = language
-            session.add(user)
-            session.commit()
-            logger.info(f"User {user.telegram_user_id} successfully changed language to {language}")
+        return user is not None
+
+    try:
+        if writer.run(update):
+            user_cache.invalidate(user_id)
+            logger.info(f"User {user_id} successfully changed language to {language}")
             return True
-        except exc.SQLAlchemyError:
-            logger.error(f"Database error while changing {user.telegram_user_id}'s language to {language}")
+        else:
+            logger.error(f"Can't find user with telegram ID {user_id} in DB while changing language to {language}")
             return False
-    else:
-        logger.error(f"Can't find user with telegram ID {user_id} in DB while changing language to {language}")
+    except exc.SQLAlchemyError:
+        logger.error(f"Database error while changing {user_id}'s language to {language}")
         return False
 
 
@@ -224,21 +437,25 @@ def mute_user_notifications(user_id: int) -> bool:
         True if success else False.
     """
 
-    user = get_user(user_id=user_id)
-    muted = False
-    if user:
-        try:
-            if not user.muted:
-                muted = True
-            user.muted = muted
-            session.add(user)
-            session.commit()
-            logger.info(f"User {user.telegram_user_id} successfully set muted notification to {muted} ")
+    def update(write_session: Session) -> bool | None:
+        user = query_user(write_session, user_id)
+        if user:
+            user.muted = not user.muted
+            set_next_fire(user)
+            return user.muted
+        return None
+
+    try:
+        muted = writer.run(update)
+        if muted is not None:
+            user_cache.invalidate(user_id)
+            logger.info(f"User {user_id} successfully set muted notification to {muted} ")
             return True
-        except exc.SQLAlchemyError:
-            logger.error(f"Database error while setting {user.telegram_user_id}'s muted notification to {muted}")
-    else:
-        logger.error(f"Can't find user with telegram ID {user_id} in DB while setting muted notification to {muted}")
+        else:
+            logger.error(f"Can't find user with telegram ID {user_id} in DB while changing muted notification")
+            return False
+    except exc.SQLAlchemyError:
+        logger.error(f"Database error while changing {user_id}'s muted notification")
         return False
 
 
@@ -254,26 +471,29 @@ def update_user_notifications(user_id: int, choice: str, time: str) -> bool:
         True if success else False.
     """
 
-    user = get_user(user_id=user_id)
     new_time = datetime.datetime.strptime(time, "%H:%M")
-    if user:
-        try:
+
+    def update(write_session: Session) -> bool:
+        user = query_user(write_session, user_id)
+        if user:
             if choice == "time_from":
                 user.notifications_from = new_time.time()
             elif choice == "time_to":
                 user.notifications_to = new_time.time()
-            session.add(user)
-            session.commit()
-            logger.info(f"User {user.telegram_user_id} successfully changed notification {choice} "
-                        f"to {new_time.time()}")
+            set_next_fire(user)
+        return user is not None
+
+    try:
+        if writer.run(update):
+            user_cache.invalidate(user_id)
+            logger.info(f"User {user_id} successfully changed notification {choice} to {new_time.time()}")
             return True
-        except exc.SQLAlchemyError:
-            logger.error(f"Database error while changing {user.telegram_user_id}'s notification {choice} "
+        else:
+            logger.error(f"Can't find user with telegram ID {user_id} in DB while changing notification {choice} "
                          f"to {new_time.time()}")
             return False
-    else:
-        logger.error(f"Can't find user with telegram ID {user_id} in DB while changing notification {choice} "
-                     f"to {new_time.time()}")
+    except exc.SQLAlchemyError:
+        logger.error(f"Database error while changing {user_id}'s notification {choice} to {new_time.time()}")
         return False
 
 
@@ -0,0 +1,106 @@
+import hmac
+import json
+from typing import Callable
+from telebot import TeleBot, types
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from loader import logger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    HTTP server receiving updates from Telegram via webhook. Every POST request with valid secret token is passed to
+    the bot handlers, requests without it are rejected, so the secret token is required. Updates are processed one by
+    one in the server thread in order of arrival, as in polling mode.
+    """
+
+    def __init__(self, bot: TeleBot, secret_token: str, host: str = "0.0.0.0", port: int = 80,
+                 path: str = "/webhook", on_error: Callable[[Exception], None] = None):
+        if not secret_token:
+            raise ValueError("Webhook secret token is required")
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.on_error = on_error
+        self.server = HTTPServer((host, port), self.make_handler())
+
+    @property
+    def address(self) -> tuple[str, int]:
+        """
+        Host and port the server is listening on.
+        """
+
+        return self.server.server_address[:2]
+
+    def serve_forever(self) -> None:
+        logger.info(f"Webhook server is listening on {self.address[0]}:{self.address[1]}{self.path}")
+        self.server.serve_forever()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def is_authorized(self, token: str | None) -> bool:
+        """
+        Checks secret token of the request.
+        Args:
+            token: Value of secret token header.
+
+        Returns:
+            True if request is authorized else False.
+        """
+
+        return token is not None and hmac.compare_digest(token, self.secret_token)
+
+    def process_update(self, data: dict) -> None:
+        """
+        Passes the update to the bot handlers. Handler errors are reported by "on_error" callback and don't stop the
+        server, so Telegram doesn't deliver the same update again.
+        Args:
+            data: Update received from Telegram.
+
+        Returns:
+            None
+        """
+
+        try:
+            self.bot.process_new_updates([types.Update.de_json(data)])
+        except Exception as e:
+            logger.exception(f"Update {data.get('update_id')} processing failed")
+            if self.on_error is not None:
+                self.on_error(e)
+
+    def make_handler(self) -> type:
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def respond(self, status: int) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self) -> None:
+                if self.path != webhook.path:
+                    self.respond(404)
+                    return
+                if not webhook.is_authorized(self.headers.get(SECRET_HEADER)):
+                    logger.warning(f"Webhook request from {self.client_address[0]} with invalid secret token")
+                    self.respond(403)
+                    return
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+                except ValueError:
+                    self.respond(400)
+                    return
+                if not isinstance(data, dict):
+                    self.respond(400)
+                    return
+                webhook.process_update(data)
+                self.respond(200)
+
+        return Handler
@@ -0,0 +1,181 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from telebot import TeleBot, types
+from metrics import BotMetrics
+
+logger = logging.getLogger("bot")
+
+
+def get_chat_id(update: types.Update) -> int | None:
+    """
+    Defines the chat the update belongs to.
+    Args:
+        update: Telegram update.
+
+    Returns:
+        Chat ID or None if the update isn't related to any chat.
+    """
+
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+def get_update_type(update: types.Update) -> str:
+    """
+    Defines the update type.
+    Args:
+        update: Telegram update.
+
+    Returns:
+        Name of the update field set, f.e. "message" or "callback_query".
+    """
+
+    for update_type in ("message", "callback_query", "edited_message", "channel_post", "edited_channel_post",
+                        "inline_query", "chosen_inline_result", "my_chat_member", "chat_member"):
+        if getattr(update, update_type) is not None:
+            return update_type
+    return "other"
+
+
+class ChatExecutor:
+    """
+    Pool of workers running tasks of different chats concurrently. Tasks of the same chat are queued and run one by one
+    in order of submitting, so a slow task of one chat doesn't block other chats and the dialog steps of every chat
+    stay ordered.
+    """
+
+    def __init__(self, workers: int, on_done: Callable[[], None] = None, on_error: Callable[[Exception], None] = None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update")
+        self.on_done = on_done
+        self.on_error = on_error
+        self.queues = {}
+        self.condition = threading.Condition()
+
+    def submit(self, chat_id: int | None, task: Callable, *args) -> None:
+        """
+        Submits the task of the chat. Tasks without chat are run without ordering.
+        Args:
+            chat_id: Chat ID.
+            task: Callable to run.
+            *args: Task arguments.
+
+        Returns:
+            None
+        """
+
+        key = chat_id if chat_id is not None else object()
+        with self.condition:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((task, args))
+                return
+            self.queues[key] = deque([(task, args)])
+        self.pool.submit(self.drain, key)
+
+    def drain(self, key) -> None:
+        """
+        Runs queued tasks of the chat until the queue is empty.
+        Args:
+            key: Chat queue key.
+
+        Returns:
+            None
+        """
+
+        while True:
+            with self.condition:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    self.condition.notify_all()
+                    return
+                task, args = queue[0]
+            try:
+                task(*args)
+            except Exception as e:
+                logger.exception(f"Task of chat {key} failed")
+                if self.on_error is not None:
+                    self.on_error(e)
+            finally:
+                if self.on_done is not None:
+                    self.on_done()
+            with self.condition:
+                queue.popleft()
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Waits until all submitted tasks are done.
+        Args:
+            timeout: Maximum waiting time in seconds.
+
+        Returns:
+            True if all tasks are done else False.
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queues, timeout)
+
+
+class UpdateBot(TeleBot):
+    """
+    TeleBot processing updates by pool of workers with per-chat ordering if number of workers is set, else updates are
+    processed one by one in the polling or webhook thread. It's used in polling and webhook modes. If metrics are set,
+    processing time and database queries of every update and execution time of every handler are observed.
+    """
+
+    def __init__(self, token: str, workers: int = 0, on_done: Callable[[], None] = None, metrics: BotMetrics = None,
+                 **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.executor = ChatExecutor(workers, on_done=on_done) if workers > 0 else None
+        self.metrics = metrics
+
+    def add_message_handler(self, handler_dict: dict) -> None:
+        if self.metrics is not None:
+            handler_dict["function"] = self.metrics.wrap_handler(handler_dict["function"])
+        super().add_message_handler(handler_dict)
+
+    def add_callback_query_handler(self, handler_dict: dict) -> None:
+        if self.metrics is not None:
+            handler_dict["function"] = self.metrics.wrap_handler(handler_dict["function"])
+        super().add_callback_query_handler(handler_dict)
+
+    def register_next_step_handler_by_chat_id(self, chat_id: int, callback: Callable, *args, **kwargs) -> None:
+        if self.metrics is not None:
+            callback = self.metrics.wrap_handler(callback)
+        super().register_next_step_handler_by_chat_id(chat_id, callback, *args, **kwargs)
+
+    def process_update(self, update: types.Update) -> None:
+        """
+        Passes single update to TeleBot handlers.
+        Args:
+            update: Telegram update.
+
+        Returns:
+            None
+        """
+
+        if self.metrics is None:
+            super().process_new_updates([update])
+            return
+        with self.metrics.track_update(get_update_type(update)):
+            super().process_new_updates([update])
+
+    def process_new_updates(self, updates: list[types.Update]) -> None:
+        # Updates are passed to TeleBot one by one: TeleBot skips every second message with next step handler in a
+        # batch of messages.
+        for update in updates:
+            if self.executor is None:
+                self.process_update(update)
+                continue
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.executor.submit(get_chat_id(update), self.process_update, update)
@@ -0,0 +1,146 @@
+import time
+import queue
+import logging
+import threading
+import sqlalchemy.engine
+from typing import Any, Callable
+from concurrent.futures import Future
+from sqlalchemy.orm import Session, sessionmaker
+
+logger = logging.getLogger("bot")
+
+# Write operation gets the session, changes objects in it and returns the result without committing.
+Operation = Callable[[Session], Any]
+
+
+class DirectWriter:
+    """
+    Runs write operation in the caller session and commits it at once.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    def run(self, operation: Operation) -> Any:
+        """
+        Runs write operation and commits it.
+        Args:
+            operation: Write operation.
+
+        Returns:
+            Operation result. Raises the operation or commit error.
+        """
+
+        try:
+            result = operation(self.session)
+            self.session.commit()
+            return result
+        except Exception:
+            self.session.rollback()
+            raise
+
+
+class GroupCommitWriter:
+    """
+    Runs write operations of all threads in a single writer thread and commits operations received within "window"
+    seconds in one transaction, so there is one fsync of SQLite database per group instead of one per operation.
+    Every operation is run in its own savepoint, so a failed operation is rolled back alone and only its caller gets
+    the error. Callers wait until their operation is committed.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, window: float = 0.005, max_batch: int = 100):
+        self.session_factory = sessionmaker(bind=engine)
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.serve, name="writer", daemon=True)
+        self.thread.start()
+
+    def run(self, operation: Operation) -> Any:
+        """
+        Runs write operation in writer thread and waits until it's committed.
+        Args:
+            operation: Write operation.
+
+        Returns:
+            Operation result. Raises the operation or commit error.
+        """
+
+        future = Future()
+        self.queue.put((operation, future))
+        return future.result()
+
+    def collect(self) -> list[tuple[Operation, Future]]:
+        """
+        Waits for the first operation and collects operations received within the window after it.
+        Returns:
+            List of (operation, future) pairs.
+        """
+
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def commit(self, batch: list[tuple[Operation, Future]]) -> None:
+        """
+        Runs operations in one transaction and sets their results.
+        Args:
+            batch: List of (operation, future) pairs.
+
+        Returns:
+            None
+        """
+
+        done = []
+        with self.session_factory() as session:
+            try:
+                # pysqlite doesn't begin transaction before the first savepoint, so the savepoint release would be
+                # committed at once. Transaction is begun explicitly and takes the write lock for the whole group.
+                session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+                for operation, future in batch:
+                    try:
+                        # Changes are flushed on savepoint release, so the operation is done after it.
+                        with session.begin_nested():
+                            result = operation(session)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        done.append((future, result))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logger.exception(f"Group commit of {len(batch)} operations failed")
+                for future, result in done:
+                    future.set_exception(e)
+                for operation, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        for future, result in done:
+            future.set_result(result)
+
+    def serve(self) -> None:
+        """
+        Commits groups of operations until the process exits.
+        Returns:
+            None
+        """
+
+        while True:
+            batch = self.collect()
+            try:
+                self.commit(batch)
+            except Exception as e:
+                # Callers mustn't wait forever if the group fails outside of the transaction.
+                logger.exception("Writer failed")
+                for operation, future in batch:
+                    if not future.done():
+                        future.set_exception(e)